@@ -29,6 +29,12 @@ String u;
 //#define UNO 1
 #define PORTENTA 1
 
+//One bin per 10-bit output code, for histNx. At 4 kB this does not fit in the UNO's
+//2 kB of SRAM, so histNx is left out of UNO builds.
+#if !defined(UNO)
+uint32_t hist_buffer[1024];
+#endif
+
 
 // *** CDAC CONTROL MACROS ***
 //Note that EMULATOR takes precedence over ARDUINO/PORTENTA if asserted.
@@ -223,6 +229,13 @@ void loop() {
 if (u.substring(0, 6) == "echo:o") {
   user_echo = (u.substring(6, 1) == "n");
 
+} else if (u == "bin:on") {
+  //Binary framed mode, see generic_hal.h
+  hal_binary_mode = true;
+
+} else if (u == "bin:off") {
+  hal_binary_mode = false;
+
 } else if (u == "rc") {
     report_config();
   //sc = SET CONFIG
@@ -317,6 +330,18 @@ if (u.substring(0, 6) == "echo:o") {
     for (int i = 0; i < (1 + numConversions / 100); i++) {
       do_conversion_100x();
     }
+  } else if (u.substring(0, 7) == "histNx:") {
+#if defined(UNO)
+    Serial.println("ERR: histNx is not available on the UNO (not enough RAM)");
+#else
+    if (hal_binary_mode) {
+      //histNx prints text lines; the host reads them with command_hist(), which needs "bin:off".
+      Serial.println("ERR: histNx is not available in binary mode, send bin:off first");
+    } else {
+      numConversions = atol(u.substring(u.indexOf(':') + 1).c_str());
+      do_histogram_Nx(numConversions);
+    }
+#endif
   } else if (u == "samp100x") {
     do_sample_100x();
   } else if (u == "samp") {
@@ -430,6 +455,11 @@ void  do_conversion_100x() {
     data_buffer[i] = bin_array_to_dec_big_endian(data_array, 10);
   }
 
+  if (hal_binary_mode) {
+    send_u16_frame(data_buffer, 100);
+    return;
+  }
+
   //Serial.println("did convs!");
   String measurements = String();
   for (int i = 0; i < 100; i++) {
@@ -441,6 +471,30 @@ void  do_conversion_100x() {
   //Serial.print("\n");
 }
 
+#if !defined(UNO)
+/** do_histogram_Nx - runs do_conversion() n times and accumulates a histogram of the
+    output codes on the MCU. Only the non-empty bins are printed, one "code,count" per line,
+    so the serial traffic does not grow with n.
+*/
+void do_histogram_Nx(long n) {
+  memset(hist_buffer, 0, sizeof(hist_buffer));
+
+  for (long i = 0; i < n; i++) {
+    do_conversion(data_array);
+    delayMicroseconds(5);
+    hist_buffer[bin_array_to_dec_big_endian(data_array, 10)]++;
+  }
+
+  for (int code = 0; code < 1024; code++) {
+    if (hist_buffer[code] > 0) {
+      Serial.print(code);
+      Serial.print(",");
+      Serial.println(hist_buffer[code]);
+    }
+  }
+}
+#endif
+
 void deassert_cdac_fe_signals() {
   //Zero out PreSamp, PostSamp, Rst.
   deassert_presamp();
@@ -566,6 +620,11 @@ void do_sample_100x() {
     data_buffer[i] = bin_array_to_dec_big_endian(data_array, 10);
   }
 
+  if (hal_binary_mode) {
+    send_u16_frame(data_buffer, 100);
+    return;
+  }
+
   for (int i = 0; i < 100; i++) {
     Serial.println(data_buffer[i]);
   }
@@ -18,6 +18,61 @@
 // 	);
 // }
 
+// * * * BINARY FRAMED MODE * * *
+// When hal_binary_mode is set (command "bin:on"), bulk data is sent as binary frames:
+//
+//    SYNC (0xA5) | TYPE (1B) | LEN (2B, little-endian) | PAYLOAD (LEN bytes) | CHECKSUM (2B, little-endian)
+//
+// CHECKSUM is the Fletcher-16 of TYPE, LEN and PAYLOAD. Ordinary text output is still sent
+// as plain ASCII in between frames; since 0xA5 never appears in ASCII text, the host can
+// always find the start of the next frame. The "?" prompt is replaced by a HAL_FRAME_PROMPT
+// frame, so the host knows exactly when a command's response is complete.
+#define HAL_FRAME_SYNC 0xA5
+#define HAL_FRAME_PROMPT 0x01 // Empty payload; the HAL is waiting for the next command.
+#define HAL_FRAME_U16 0x02    // Payload is an array of little-endian uint16 values.
+
+bool hal_binary_mode = false;
+
+/**
+ * fletcher16_update - Adds len bytes of data to a running Fletcher-16 checksum (sum1, sum2).
+ */
+void fletcher16_update(uint16_t& sum1, uint16_t& sum2, const uint8_t* data, uint16_t len) {
+  for (uint16_t i = 0; i < len; i++) {
+    sum1 = (sum1 + data[i]) % 255;
+    sum2 = (sum2 + sum1) % 255;
+  }
+}
+
+/**
+ * send_frame - Sends one binary frame over Serial.
+ *  ARGUMENTS:
+ *      type    - frame type (HAL_FRAME_*)
+ *      payload - payload bytes (may be NULL if len is 0)
+ *      len     - payload length in bytes
+ */
+void send_frame(uint8_t type, const uint8_t* payload, uint16_t len) {
+  uint8_t header[4] = { HAL_FRAME_SYNC, type, (uint8_t)(len & 0xFF), (uint8_t)(len >> 8) };
+  uint16_t sum1 = 0;
+  uint16_t sum2 = 0;
+
+  fletcher16_update(sum1, sum2, &header[1], 3);
+  fletcher16_update(sum1, sum2, payload, len);
+
+  uint8_t checksum[2] = { (uint8_t)sum1, (uint8_t)sum2 };
+
+  Serial.write(header, 4);
+  if (len > 0) Serial.write(payload, len);
+  Serial.write(checksum, 2);
+}
+
+/**
+ * send_u16_frame - Sends an array of uint16 values as one HAL_FRAME_U16 frame.
+ * Values are sent in native byte order, which is little-endian on all supported boards.
+ */
+void send_u16_frame(const uint16_t* values, uint16_t count) {
+  send_frame(HAL_FRAME_U16, (const uint8_t*)values, count * sizeof(uint16_t));
+}
+
 /**
  * get_user_string - Gets a string from the user over Serial, trims it, and returns it.
  *  ARGUMENTS:
@@ -29,7 +84,11 @@
 void get_user_string(String& u) {
   //Clear any serial input that comes before "?"
   while (Serial.available()) Serial.read();
-  Serial.print("?");
+  if (hal_binary_mode) {
+    send_frame(HAL_FRAME_PROMPT, NULL, 0);
+  } else {
+    Serial.print("?");
+  }
 
   while (!Serial.available())
     ;  //Wait for serial
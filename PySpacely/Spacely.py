@@ -406,8 +406,14 @@ while True:
                     if not sg.ARDUINO_CONNECTED:
                         sg.log.error("Cannot send command: HAL not connected. Use \"arduino\" command to connect.")
                         continue
-                    #r = command_ng(sg.log, sg.port, cmd_txt[1:])
-                    r = command(sg.port, cmd_txt[1:]) # for now it uses the old command due to streaming support
+                    stream = command_stream(sg.log, sg.port, cmd_txt[1:])
+                    try:
+                        for line in stream:
+                            print(line)
+                    except KeyboardInterrupt:
+                        print("Ctrl-C detected! Stopping the HAL stream.")
+                    finally:
+                        stream.close()
 
                 case '~':
                     #Routines should be called as "~r0"
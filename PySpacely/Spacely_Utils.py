@@ -229,19 +229,21 @@ def reserve_dated_file(contents_desc: str, extension: str = 'csv', directory: st
     return file
 
 def bitstring_avg(bitstring):
+    """Returns the fraction of 1s in a string of '0'/'1' characters, or in an array of 0/1 values."""
+    if isinstance(bitstring, str):
+        bitstring = np.frombuffer(bitstring.encode('ascii'), dtype=np.uint8) - ord('0')
 
-    avg = 0
     sg.log.debug(bitstring)
-    for i in range(len(bitstring)):
-        if bitstring[i]=="1":
-            avg = avg + 1.0/len(bitstring)
+    avg = float(np.mean(bitstring == 1)) if len(bitstring) > 0 else 0
 
     sg.log.debug(avg)
     return round(avg,2)
 
 def liststring_avg_stdev(liststring):
-    myList = [int(x.strip()) for x in liststring.split()]
-    return (np.mean(myList), np.std(myList))
+    """Returns (mean, stdev) of a whitespace-separated string of numbers, or of an array of them."""
+    if isinstance(liststring, str):
+        liststring = np.array(liststring.split(), dtype=np.int64)
+    return (np.mean(liststring), np.std(liststring))
 
 
 def binned_histogram(result_list, bin_size) -> dict[float, int]:
@@ -278,30 +280,99 @@ def liststring_histogram(liststring) -> dict[int, int]:
     :param liststring: A whitespace-separated string of numbers
     :return: Dictionary where keys are bins, and values are count of a given bin
     """
-    myList = [int(x.strip()) for x in liststring.split()]
-    result = {}
+    return array_histogram(np.array(liststring.split(), dtype=np.int64))
 
-    for value in myList:
-        if value in result.keys():
-            result[value] += 1
-        else:
-            result[value] = 1
+def array_histogram(values) -> dict[int, int]:
+    """
+    Same as liststring_histogram(), but for an array of integers (e.g. from command_ng_array()).
+    Bins with no counts are left out.
 
-    return result
+    :param values: NumPy array (or list) of integers
+    :return: Dictionary where keys are bins, and values are count of a given bin
+    """
+    values = np.asarray(values, dtype=np.int64)
+    if len(values) == 0:
+        return {}
+
+    offset = values.min()
+    counts = np.bincount(values - offset)
+    bins = np.flatnonzero(counts)
+
+    return dict(zip((bins + offset).tolist(), counts[bins].tolist()))
 
 def progress_pct(completed, total):
     return str(round(completed/total*100,1))+"%"
 
 ## MAIN EVALUATION FUNCTIONS ##
 
+def find_trip_point(measure, Vtest_sweep, refine_margin: int = 2):
+    """
+    Finds the trip point of a comparator response over a sorted list of test voltages, i.e. the
+    last voltage whose average response is below 0.5 while the next one's is above 0.5.
+    Instead of measuring at every voltage, bisects on the 50% crossing and then sweeps a few
+    points on either side of it, where the response is noisy.
+
+    :param measure: Function taking a test voltage, returning the average response (0 to 1) there
+    :param Vtest_sweep: Sorted list of test voltages
+    :param refine_margin: Number of extra points to sweep on either side of the bisected crossing
+    :return: (Vtrip, samples), where samples is a dictionary of every measured voltage and its response.
+             Vtrip is None if Vtest_sweep is empty.
+    """
+    samples = {}
+
+    if len(Vtest_sweep) == 0:
+        sg.log.error("find_trip_point: Vtest_sweep is empty, nothing to measure")
+        return None, samples
+
+    def sample(i):
+        v = Vtest_sweep[i]
+        if v not in samples:
+            samples[v] = measure(v)
+        return samples[v]
+
+    lo = 0
+    hi = len(Vtest_sweep) - 1
+
+    #Same results as a full sweep when the crossing is outside the range.
+    if sample(hi) < 0.5:
+        return Vtest_sweep[hi], samples
+    if sample(lo) >= 0.5:
+        sg.log.warning(f"Response is already {samples[Vtest_sweep[lo]]} at {Vtest_sweep[lo]}mV; no trip point in range")
+        return 0, samples
+
+    #Invariant: response at lo is < 0.5, response at hi is >= 0.5.
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if sample(mid) < 0.5:
+            lo = mid
+        else:
+            hi = mid
+
+    #Local sweep around the crossing, applying the same rule as a full sweep.
+    Vtrip = Vtest_sweep[lo]
+    first = max(0, lo - refine_margin)
+    last = min(len(Vtest_sweep) - 1, hi + refine_margin)
+    for i in range(first, last + 1):
+        if sample(i) < 0.5 and (i+1 == len(Vtest_sweep) or sample(i+1) > 0.5):
+            Vtrip = Vtest_sweep[i]
+
+    return Vtrip, samples
+
+
 # find_DNL returns the mid-point DNL of the CDAC transfer function for the presently set CapTrim value.
-def find_DNL(Vtest_min_mV = 495, Vtest_max_mV = 505,increment_uV = 100, logfile=None):
+# With return_samples=True it returns (DNL, samples) instead, where samples holds the responses measured
+# for each CDAC code while finding its trip point.
+def find_DNL(Vtest_min_mV = 495, Vtest_max_mV = 505,increment_uV = 100, logfile=None, refine_margin = 2, return_samples = False):
 
      #Generate a range w/ steps of 0.1mV
     cdac_codes = ["0111111111","1000000000","1000000001"]
-    avg_response = [[],[],[]]
     Vtest_sweep = [round(x*0.1,1) for x in range(10*Vtest_min_mV,10*Vtest_max_mV,int(increment_uV/100))]
     Vtrip = [0,0,0]
+    samples = {}
+
+    if len(Vtest_sweep) == 0:
+        sg.log.error(f"find_DNL: no test voltages between {Vtest_min_mV} and {Vtest_max_mV} mV")
+        return (None, samples) if return_samples else None
 
     #config_AWG_as_DC(0)
 
@@ -312,7 +383,8 @@ def find_DNL(Vtest_min_mV = 495, Vtest_max_mV = 505,increment_uV = 100, logfile=
         if logfile is not None:
             logfile.write("Finding trip pt for "+cdac_codes[c]+"\n")
         #log.debug("Finding trip pt for "+cdac_codes[c])
-        for v in Vtest_sweep:
+
+        def measure(v):
             set_Vin_mV(v)
 
             if logfile is not None:
@@ -320,32 +392,27 @@ def find_DNL(Vtest_min_mV = 495, Vtest_max_mV = 505,increment_uV = 100, logfile=
             sg.log.debug(v)
 
             #Run the command to send the CDAC pattern 100 times.
-            #x = time.perf_counter_ns()
-            r = command_ng(sg.log, sg.port, "cdac100x:"+cdac_codes[c])
-            #print(time.perf_counter_ns()-x)
-            #Format the response
-            r = r.replace("cdac100x:"+cdac_codes[c],"").replace("?","").strip()
+            r = command_ng_bits(sg.log, sg.port, "cdac100x:"+cdac_codes[c])
 
             if logfile is not None:
-                logfile.write(r+"\n")
+                logfile.write("".join(map(str, r.tolist()))+"\n")
 
-            #Find the average value and append it to the appropriate list.
-            avg_response[c].append(bitstring_avg(r))
+            return bitstring_avg(r)
 
+        Vtrip[c], samples[cdac_codes[c]] = find_trip_point(measure, Vtest_sweep, refine_margin)
 
     #Print the output for verification.
-    for v in range(len(Vtest_sweep)):
-        print(Vtest_sweep[v], end=' ')
-        for c in range(len(cdac_codes)):
-            print(avg_response[c][v],end=' ')
-            if avg_response[c][v]<0.5 and (v+1==len(Vtest_sweep) or avg_response[c][v+1] > 0.5):
-                Vtrip[c] = Vtest_sweep[v]
-        print("")
+    for c in range(len(cdac_codes)):
+        print(cdac_codes[c], f"({len(samples[cdac_codes[c]])} of {len(Vtest_sweep)} points sampled)")
+        for v in sorted(samples[cdac_codes[c]]):
+            print(v, samples[cdac_codes[c]][v])
 
     print("Vtrip points are:",Vtrip)
     DNL = (Vtrip[2]-Vtrip[1])-(Vtrip[1]-Vtrip[0])
     print("DNL is ",DNL)
 
+    if return_samples:
+        return DNL, samples
     return DNL
 
 
@@ -376,10 +443,7 @@ def Vin_sweep(Vtest_min_mV: int = 0, Vtest_max_mV: int = 10, increment_uV: int =
             if PROGRESS and v % (len(Vtest_sweep)/20)==0:
                 print("|",end="")
 
-            r = command_ng(sg.log, sg.port, "conv100x")
-
-            #Format the response
-            r = r.replace("conv100x","").replace("?","").strip()
+            r = command_ng_array(sg.log, sg.port, "conv100x")
 
             x = liststring_avg_stdev(r)
 
@@ -407,8 +471,7 @@ def Vin_sweep_full_chain(Vtest_min_mV: int = 10, Vtest_max_mV: int = 100, increm
         
         for v in range(len(Vtest_sweep)):
             set_pulse_mag(Vtest_sweep[v])
-            r = command_ng(sg.log, sg.port, "samp100x")
-            r = r.replace("samp100x","").replace("?","").strip()
+            r = command_ng_array(sg.log, sg.port, "samp100x")
 
             x = liststring_avg_stdev(r)
 
@@ -422,55 +485,145 @@ def Vin_histogram(Vtest_mV: int, points: int) -> dict[int, int]:
 
     :param Vtest_mV: Voltage to test at in milli-volts
     :param points: Number of samples to take
-    :return: See "liststring_histogram()" docblcok
+    :return: Dictionary where keys are output codes, and values are count of a given code
     """
 
     config_AWG_as_DC(Vtest_mV)
 
     if sg.TARGET == "SPROCKET1":
         #r = command(sg.port, "convNx:"+str(points), printresponse=False, timeout_s=10)
-        r = command_ng(sg.log, sg.port, f"convNx:{points}")
+        # The histogram is accumulated on the Arduino; only the bin counts come back.
+        # UNO builds and binary mode reject histNx, and older HAL firmware does not know
+        # it at all; those fall back to sending every conversion with convNx.
+        try:
+            histogram = command_hist(sg.log, sg.port, points)
+        except IOError as e:
+            sg.log.debug(f"{e}, using convNx instead")
+        else:
+            if len(histogram) > 0:
+                return histogram
+            sg.log.debug("HAL histNx returned nothing, using convNx instead")
 
-        #log.debug(f"convNx returned: {r}") # this will return A LOT of lines!
-        sg.log.debug(f"Number of values returned: {len(r.split())}")
+        r = command_ng_array(sg.log, sg.port, f"convNx:{points}")
 
-        #Format the response
-        liststring = r.replace("convNx:"+str(points),"").replace("?","").strip()
+        sg.log.debug(f"Number of values returned: {len(r)}")
 
-        return liststring_histogram(liststring)
+        return array_histogram(r)
 
         
 
 
-def center_code(Vtest_init_mV: float, samples_per_val: int = 1000):
+def histogram_stats(histogram: dict[int, int]):
+    """
+    Summarizes how a histogram of output codes is spread around its mode.
 
+    :param histogram: Dictionary where keys are bins, and values are count of a given bin
+    :return: (mode, mean, count_below_mode, count_above_mode)
+    """
+    mode = max(histogram, key=histogram.get) # primary bin count/statistical mode of all values in histogram
+    total = sum(histogram.values())
+    mean = sum(bin_val * bin_count for bin_val, bin_count in histogram.items()) / total
 
-    Vtest = Vtest_init_mV
-    Vtest_last = Vtest_init_mV
+    count_below = 0
+    count_above = 0
+    for bin_val, bin_count in histogram.items():
+        if bin_val > mode:
+            count_above += bin_count
+        elif bin_val < mode:
+            count_below += bin_count
 
-    count_outside = 1000
+    return mode, mean, count_below, count_above
 
-    sg.log.info(f"Running centering code from {Vtest_init_mV}mV...")
 
-    while True:
-        histogram = Vin_histogram(Vtest, samples_per_val)
-        mode = max(histogram, key=histogram.get) # primary bin count/statistical mode of all values in histogram
-        #print(histogram)
+def center_code(Vtest_init_mV: float, samples_per_val: int = 1000, max_secant_steps: int = 10, max_step_mV: float = 1.0,
+                lsb_mV: float = 1.0):
+    """
+    Finds the Vtest near Vtest_init_mV that is centered in its output code, i.e. where the fewest
+    samples fall outside the mode of the histogram.
+
+    How far the histogram's mean is from the code it should be centered on tells how far off Vtest
+    is, so a secant search on that offset gets close within a few histograms. The first step is the
+    offset times the LSB; later ones come from the slope between the last two histograms. Once the
+    correction gets below 0.1 mV, the final 0.1 mV steps are taken as before.
+
+    :param Vtest_init_mV: Starting guess in milli-volts
+    :param samples_per_val: Number of samples in each histogram
+    :param max_secant_steps: Maximum number of secant steps before switching to 0.1 mV steps
+    :param max_step_mV: Largest correction a single secant step may make
+    :param lsb_mV: Approximate size of one output code in milli-volts, used for the first step
+    :return: Centered Vtest in milli-volts
+    """
 
-        count_below = 0
-        count_above = 0
-        for bin_val, bin_count in histogram.items():
-            if bin_val > mode:
-                count_above += bin_count
-            elif mode < bin_val:
-                count_below += bin_count
+    sg.log.info(f"Running centering code from {Vtest_init_mV}mV...")
+    histograms_taken = 0
 
-        sg.log.debug(f"Vtest:{Vtest:.2f}mV, mode:{mode}, count_below_mode:{count_below}, count_above_mode:{count_above}")
+    def measure(Vtest):
+        nonlocal histograms_taken
+        histograms_taken += 1
+        mode, mean, count_below, count_above = histogram_stats(Vin_histogram(Vtest, samples_per_val))
+        sg.log.debug(f"Vtest:{Vtest:.2f}mV, mode:{mode}, mean:{mean:.3f}, count_below_mode:{count_below}, count_above_mode:{count_above}")
 
         # That shouldn't be the case really... something is probably misconnected
         if mode == 0:
             sg.log.warning(f"Suspicious mode of 0 for Vtest={Vtest:.2f}mV")
 
+        return mode, mean, count_below, count_above
+
+    Vtest = Vtest_init_mV
+    mode, mean, count_below, count_above = measure(Vtest)
+    target = mode
+    offset = mean - target
+
+    best = (count_below + count_above, Vtest, count_below, count_above)
+    Vtest_prev = None
+    offset_prev = None
+
+    #Secant search on the offset of the mean from the target code.
+    for _ in range(max_secant_steps):
+        if best[0] == 0 or offset == 0:
+            break
+
+        if Vtest_prev is None:
+            # No slope estimate yet; the offset is in codes, so one code is about one LSB.
+            step = -offset * lsb_mV
+            if abs(step) < 0.1:
+                step = -0.1 if offset > 0 else 0.1
+        elif offset == offset_prev:
+            # The last step changed nothing; probe with a 0.1 mV step in the right direction.
+            step = -0.1 if offset > 0 else 0.1
+        else:
+            step = -offset * (Vtest - Vtest_prev) / (offset - offset_prev)
+
+            if abs(step) < 0.1:
+                break
+
+        step = max(-max_step_mV, min(max_step_mV, step))
+
+        Vtest_prev = Vtest
+        offset_prev = offset
+        Vtest = Vtest + step
+
+        mode, mean, count_below, count_above = measure(Vtest)
+        offset = mean - target
+
+        if count_below + count_above < best[0]:
+            best = (count_below + count_above, Vtest, count_below, count_above)
+
+    count_outside, Vtest_last, count_below, count_above = best
+    if count_outside == 0:
+        sg.log.notice(f"Centered at Vtest: {Vtest_last:.2f}mV")
+        return Vtest_last
+    sg.log.debug(f"Secant search ended at Vtest:{Vtest_last:.2f}mV after {histograms_taken} histograms, switching to 0.1 mV steps")
+
+    while True:
+        #Tune by increments of 0.1 mV.
+        if count_above > count_below:
+            Vtest = Vtest_last - 0.1
+        else:
+            Vtest = Vtest_last + 0.1
+
+        mode, mean, count_below, count_above = measure(Vtest)
+
         #If we are less centered than the previous guess, take the
         #last one and be done with it.
         #PROOF that this loop is non-infinite: count_outside is strictly decreasing and positive.
@@ -482,12 +635,6 @@ def center_code(Vtest_init_mV: float, samples_per_val: int = 1000):
         Vtest_last = Vtest
         count_outside = count_above + count_below
 
-        #Tune by increments of 0.1 mV.
-        if count_above > count_below:
-            Vtest = Vtest - 0.1
-        else:
-            Vtest = Vtest + 0.1
-
 def dump_noise_sweep_histogram(Vtest_sweep, vtest_min_mv: int, vtest_max_mv: int, histograms: dict) -> bool:
     try:
         filename = reserve_dated_file(f"vin noise sweep HISTO {vtest_min_mv}mV to {vtest_max_mv}mV step{Vtest_sweep[1]-Vtest_sweep[0]}mV", directory='output/noise')
@@ -1,9 +1,13 @@
 # coding: utf-8
 
+import array
+import asyncio
+import binascii
 import functools
 import socket
 import struct
 import signal
+import sys
 
 
 class MaskKeyboardInterrupt:
@@ -30,6 +34,12 @@ STATUS_OK = 0
 LENGTH = struct.Struct('!L')
 # sequence number, status code
 HEADER = struct.Struct('!HH')
+# maximum number of requests in flight for pipelined requests
+PIPELINE_WINDOW = 128
+# initial size of the receive buffer, grows to fit larger replies
+RX_BUFFER_SIZE = 64 * 1024
+# maximum number of 32-bit words moved by one block transfer message
+BLOCK_TRANSFER_WORDS = 16384
 
 class UnsupportedProtocol(Exception):
     pass
@@ -43,6 +53,56 @@ class Failure(Exception):
         msg = 'Command \'{}\' failed with code {:d} \'{}\''
         super(Failure, self).__init__(msg.format(cmd, code, reason))
 
+def pack_words(values):
+    """
+    Pack a sequence of 32-bit words as little-endian bytes for block transfers.
+
+    values can be any iterable of ints, a NumPy array, or bytes that are
+    already packed.
+    """
+    if isinstance(values, (bytes, bytearray, memoryview)):
+        return bytes(values)
+    if hasattr(values, 'astype'):
+        return values.astype('<u4', copy=False).tobytes()
+    words = array.array('I', values)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words.tobytes()
+
+def unpack_words(data):
+    """
+    Unpack little-endian bytes from a block transfer into an array('I') of words.
+    """
+    words = array.array('I')
+    words.frombytes(data)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words
+
+def block_write_requests(name, values):
+    """
+    Split a block write to one named memory register into set_memory_block
+    requests of at most BLOCK_TRANSFER_WORDS words each.
+    """
+    data = pack_words(values)
+    chunk = 4 * BLOCK_TRANSFER_WORDS
+    return [('set_memory_block', name, data[i:i + chunk].hex())
+            for i in range(0, len(data), chunk)]
+
+def block_read_requests(name, n):
+    """
+    Split a read of n words from one named memory register into
+    get_memory_block requests of at most BLOCK_TRANSFER_WORDS words each.
+    """
+    return [('get_memory_block', name, min(BLOCK_TRANSFER_WORDS, n - i))
+            for i in range(0, n, BLOCK_TRANSFER_WORDS)]
+
+def join_block_replies(replies):
+    """
+    Join the replies to the requests from block_read_requests() into one array('I').
+    """
+    return unpack_words(b''.join(binascii.unhexlify(_) for _ in replies))
+
 class PearyClient(object):
     """
     Connect to a pearyd instance running somewhere else.
@@ -61,6 +121,11 @@ class PearyClient(object):
         # Cache of available device objects to avoid recreating them
         self._devices = {}
         self._sequence_number = 0
+        # Reusable receive buffer; bytes [_rx_start, _rx_end) are unread
+        self._rx_buffer = bytearray(RX_BUFFER_SIZE)
+        self._rx_view = memoryview(self._rx_buffer)
+        self._rx_start = 0
+        self._rx_end = 0
         self._socket = socket.create_connection((self.host, self.port))
         # check connection and protocol
         version = self._request('protocol_version')
@@ -100,6 +165,81 @@ class PearyClient(object):
         Contains the critical code for _request() which shouldn't be interrupted.
         """
         # 1. encode request
+        seq, req_msg = self._encode_request(cmd, *args)
+
+        # 2. send request
+        self._socket.sendall(req_msg)
+
+        # 3. wait for reply and unpack in opposite order
+        rep_seq, rep_status, rep_payload = self._recv_reply()
+        if rep_status != STATUS_OK:
+            raise Failure(cmd, rep_status, rep_payload)
+        if rep_seq != seq:
+            raise InvalidReply('Sequence number missmatch', seq, rep_seq)
+            
+        return rep_payload
+
+    def _request_pipelined(self, requests, return_exceptions=False):
+        """
+        Send many commands back to back and return their reply payloads.
+
+        requests is a list of tuples (cmd, arg0, arg1, ...). Up to
+        PIPELINE_WINDOW requests are kept in flight at once and replies are
+        matched to requests by sequence number, so the cost is one round-trip
+        per window instead of one per request. The returned list is in the
+        same order as requests.
+
+        All replies are always drained before returning. If any command
+        failed, the first Failure (in request order) is raised, unless
+        return_exceptions is True in which case the Failure objects are
+        returned in place of the payloads.
+        """
+        with MaskKeyboardInterrupt():
+            return self._request_pipelined_nointerrupt(requests, return_exceptions)
+
+    def _request_pipelined_nointerrupt(self, requests, return_exceptions):
+        """
+        Contains the critical code for _request_pipelined() which shouldn't be interrupted.
+        """
+        results = [None] * len(requests)
+        # sequence number -> index into requests for every request in flight
+        pending = {}
+        n_sent = 0
+        n_received = 0
+
+        while n_received < len(requests):
+            # 1. top up the window once it is half empty, sending all new
+            # requests with a single call
+            if n_sent < len(requests) and len(pending) <= PIPELINE_WINDOW // 2:
+                req_msgs = []
+                while n_sent < len(requests) and len(pending) < PIPELINE_WINDOW:
+                    seq, req_msg = self._encode_request(*requests[n_sent])
+                    pending[seq] = n_sent
+                    req_msgs.append(req_msg)
+                    n_sent += 1
+                self._socket.sendall(b''.join(req_msgs))
+
+            # 2. match the next reply to its request
+            rep_seq, rep_status, rep_payload = self._recv_reply()
+            idx = pending.pop(rep_seq, None)
+            if idx is None:
+                raise InvalidReply('Unexpected sequence number', rep_seq)
+            if rep_status != STATUS_OK:
+                results[idx] = Failure(requests[idx][0], rep_status, rep_payload)
+            else:
+                results[idx] = rep_payload
+            n_received += 1
+
+        if not return_exceptions:
+            for result in results:
+                if isinstance(result, Failure):
+                    raise result
+        return results
+
+    def _encode_request(self, cmd, *args):
+        """
+        Frame a command for sending and return (sequence number, message).
+        """
         # encode command and its arguments into message payload
         req_payload = [cmd,]
         req_payload.extend(str(_) for _ in args)
@@ -117,39 +257,57 @@ class PearyClient(object):
         # encode message length for framing
         req_length = LENGTH.pack(len(req_header) + len(req_payload))
 
-        #previous code
-        
-        # 2. send request
-        # self._socket.send(req_length)
-        # self._socket.send(req_header)
-        # self._socket.send(req_payload)
-        self._socket.send(req_length + req_header +req_payload)
+        return self._sequence_number, req_length + req_header + req_payload
 
-        # 3. wait for reply and unpack in opposite order
+    def _recv_reply(self):
+        """
+        Read one framed reply and return (sequence number, status, payload).
 
-        #previous code
-        
-        # rep_length, = LENGTH.unpack(self._socket.recv(4))
-        # if rep_length < 4:
-        #     raise InvalidReply('Length too small')
-        # rep_msg = self._socket.recv(rep_length)
-
-        #modified code
-        rep_packet = self._socket.recv(4096)
-        rep_length, = LENGTH.unpack(rep_packet[:4])
-        if rep_length <4:
+        The length prefix and header are unpacked in place from the receive
+        buffer; only the payload is copied out.
+        """
+        self._fill_rx_buffer(LENGTH.size)
+        rep_length, = LENGTH.unpack_from(self._rx_buffer, self._rx_start)
+        if rep_length < HEADER.size:
             raise InvalidReply('Length too small')
-        rep_msg = rep_packet[4:]
+        self._fill_rx_buffer(LENGTH.size + rep_length)
 
-        #original code
-        rep_seq, rep_status = HEADER.unpack(rep_msg[:4])
-        rep_payload = rep_msg[4:]
-        if rep_status != STATUS_OK:
-            raise Failure(cmd, rep_status, rep_payload)
-        if rep_seq != self._sequence_number:
-            raise InvalidReply('Sequence number missmatch', self._sequence_number, rep_seq)
-            
-        return rep_payload
+        rep_start = self._rx_start + LENGTH.size
+        rep_end = rep_start + rep_length
+        rep_seq, rep_status = HEADER.unpack_from(self._rx_buffer, rep_start)
+        rep_payload = bytes(self._rx_view[rep_start + HEADER.size:rep_end])
+        self._rx_start = rep_end
+        return rep_seq, rep_status, rep_payload
+
+    def _fill_rx_buffer(self, n):
+        """
+        Make sure at least n unread bytes are in the receive buffer.
+
+        Data is received with recv_into() straight into the reusable buffer,
+        taking as much as the socket has available, so back-to-back replies
+        usually cost a single system call. The buffer only grows when one
+        reply is larger than the whole buffer.
+        """
+        unread = self._rx_end - self._rx_start
+        if unread >= n:
+            return
+        if self._rx_start + n > len(self._rx_buffer):
+            # not enough room behind the unread bytes, move them to the front
+            if n > len(self._rx_buffer):
+                rx_buffer = bytearray(max(n, 2 * len(self._rx_buffer)))
+                rx_buffer[:unread] = self._rx_view[self._rx_start:self._rx_end]
+                self._rx_view.release()
+                self._rx_buffer = rx_buffer
+                self._rx_view = memoryview(rx_buffer)
+            else:
+                self._rx_view[:unread] = self._rx_view[self._rx_start:self._rx_end]
+            self._rx_start = 0
+            self._rx_end = unread
+        while self._rx_end - self._rx_start < n:
+            nbytes = self._socket.recv_into(self._rx_view[self._rx_end:])
+            if nbytes == 0:
+                raise InvalidReply('Connection closed by peer')
+            self._rx_end += nbytes
 
     def keep_alive(self):
         """
@@ -228,6 +386,14 @@ class Device(object):
         """
         return self._client._request('device.{}'.format(cmd), self.index, *args)
 
+    def _request_pipelined(self, requests, return_exceptions=False):
+        """
+        Send many per-device commands back to back and return their reply
+        payloads. See PearyClient._request_pipelined().
+        """
+        requests = [('device.{}'.format(cmd), self.index) + tuple(args) for cmd, *args in requests]
+        return self._client._request_pipelined(requests, return_exceptions)
+
     # fixed device functionality is added explicitely with
     # additional return value decoding where appropriate
 
@@ -260,6 +426,13 @@ class Device(object):
         """Set the value of a named register."""
         self._request('set_register', name, value)
 
+    def set_memory_block(self, name, values):
+        """Write a block of 32-bit words to one named memory register, in order."""
+        self._request_pipelined(block_write_requests(name, values))
+    def get_memory_block(self, name, n):
+        """Read n 32-bit words from one named memory register, in order."""
+        return join_block_replies(self._request_pipelined(block_read_requests(name, n)))
+
     def get_current(self, name):
         """Get the measured current of a named periphery port."""
         return float(self._request('get_current', name))
@@ -287,3 +460,279 @@ class Device(object):
         func = functools.partial(self._request, name)
         self.__dict__[name] = func
         return func
+
+
+class AsyncPearyClient(object):
+    """
+    asyncio counterpart of PearyClient.
+
+    Any number of coroutines may issue requests concurrently over the one
+    connection. Each request awaits the reply carrying its own sequence
+    number, which a background task dispatches as replies arrive. At most
+    PIPELINE_WINDOW requests are in flight at once.
+
+    Connect with the connect() coroutine and use the client in an async
+    with statement for automatic connection closing on errors, i.e.
+
+        async with await AsyncPearyClient.connect(host='localhost') as client:
+            device = await client.ensure_device('SpacelyCaribouBasic')
+            await asyncio.gather(device.get_voltage('PWR_OUT_1'),
+                                 device.get_memory('apg_status'))
+
+    """
+    # message framing is shared with the blocking client
+    _encode_request = PearyClient._encode_request
+
+    def __init__(self, host, port, reader, writer):
+        super(AsyncPearyClient, self).__init__()
+        self.host = host
+        self.port = port
+        # Cache of available device objects to avoid recreating them
+        self._devices = {}
+        self._sequence_number = 0
+        self._reader = reader
+        self._writer = writer
+        # sequence number -> (cmd, future) for every request in flight
+        self._pending = {}
+        self._window = asyncio.Semaphore(PIPELINE_WINDOW)
+        self._reader_task = asyncio.get_running_loop().create_task(self._read_replies())
+    @classmethod
+    async def connect(cls, host, port=12345):
+        """
+        Open a connection to pearyd and check the protocol version.
+        """
+        reader, writer = await asyncio.open_connection(host, port)
+        client = cls(host, port, reader, writer)
+        version = await client._request('protocol_version')
+        if version != PROTOCOL_VERSION:
+            await client.close()
+            raise UnsupportedProtocol(version)
+        return client
+    # support async with statements
+    async def __aenter__(self):
+        return self
+    async def __aexit__(self, *unused):
+        await self.close()
+    async def close(self):
+        """
+        Close the connection.
+
+        Requests still waiting for a reply fail with InvalidReply.
+        """
+        self._reader_task.cancel()
+        try:
+            await self._reader_task
+        except asyncio.CancelledError:
+            pass
+        for cmd, future in self._pending.values():
+            if not future.done():
+                future.set_exception(InvalidReply('Connection is closed'))
+        self._pending.clear()
+        if not self._writer.is_closing():
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except OSError:
+                pass
+
+    @property
+    def peername(self):
+        return self._writer.get_extra_info('peername')
+
+    async def _request(self, cmd, *args):
+        """
+        Send a command to the host and return the reply payload.
+        """
+        async with self._window:
+            if self._reader_task.done():
+                raise InvalidReply('Connection is closed')
+            seq, req_msg = self._encode_request(cmd, *args)
+            future = asyncio.get_running_loop().create_future()
+            self._pending[seq] = (cmd, future)
+            self._writer.write(req_msg)
+            await self._writer.drain()
+            return await future
+
+    async def _read_replies(self):
+        """
+        Background task that hands every reply to the request waiting for it.
+        """
+        try:
+            while True:
+                rep_length, = LENGTH.unpack(await self._reader.readexactly(LENGTH.size))
+                if rep_length < HEADER.size:
+                    raise InvalidReply('Length too small')
+                rep_msg = await self._reader.readexactly(rep_length)
+                rep_seq, rep_status = HEADER.unpack_from(rep_msg)
+                rep_payload = rep_msg[HEADER.size:]
+
+                cmd, future = self._pending.pop(rep_seq, (None, None))
+                if future is None:
+                    raise InvalidReply('Unexpected sequence number', rep_seq)
+                # the requesting coroutine may have been cancelled
+                if future.done():
+                    continue
+                if rep_status != STATUS_OK:
+                    future.set_exception(Failure(cmd, rep_status, rep_payload))
+                else:
+                    future.set_result(rep_payload)
+        except asyncio.CancelledError:
+            raise
+        except (asyncio.IncompleteReadError, OSError, InvalidReply) as e:
+            # the connection is unusable, fail everything still waiting
+            for cmd, future in self._pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            self._pending.clear()
+
+    async def keep_alive(self):
+        """
+        Send a keep-alive message to test the connection.
+        """
+        await self._request('')
+
+    async def list_devices(self):
+        """
+        List configured devices.
+        """
+        indices = await self._request('list_devices')
+        indices = [int(_) for _ in indices.split()]
+        return [await self.get_device(_) for _ in indices]
+    async def clear_devices(self):
+        """
+        Clear and close all configured devices.
+        """
+        await self._request('clear_devices')
+    async def get_device(self, index):
+        """
+        Get the device object corresponding to the given index.
+        """
+        device = self._devices.get(index)
+        if not device:
+            device = await AsyncDevice.create(self, index)
+            device = self._devices.setdefault(index, device)
+        return device
+    async def add_device(self, device_type, config_path=None):
+        """
+        Add a new device of the given type.
+        """
+        if(config_path):
+            index = await self._request('add_device', device_type, config_path)
+        else:
+            index = await self._request('add_device', device_type)
+        index = int(index)
+        return await self.get_device(index)
+    async def ensure_device(self, device_type):
+        """
+        Ensure at least one device of the given type exists and return it.
+
+        If there are multiple devices with the same name, the first one
+        is returned.
+        """
+        devices = await self.list_devices()
+        devices = filter(lambda _: _.device_type == device_type, devices)
+        devices = sorted(devices, key=lambda _: _.index)
+        if devices:
+            return devices[0]
+        else:
+            return await self.add_device(device_type)
+
+class AsyncDevice(object):
+    """
+    A Peary device on an AsyncPearyClient.
+
+    Same interface as Device, but every method is a coroutine. Use
+    AsyncPearyClient.get_device() or AsyncDevice.create() to get one.
+    """
+    def __init__(self, client, index, device_type):
+        super(AsyncDevice, self).__init__()
+        self._client = client
+        self.index = index
+        self.device_type = device_type
+    @classmethod
+    async def create(cls, client, index):
+        """
+        Create the device object, asking the host for the device type.
+        """
+        device_type = (await client._request('device.name', index)).decode('utf-8')
+        # internal name is actualy <name>Device, but we only use <name>
+        # to generate it. remove the suffix for consistency
+        if device_type.endswith('Device'):
+            device_type = device_type[:-6]
+        return cls(client, index, device_type)
+    def __repr__(self):
+        return 'Async{}Device(index={:d})'.format(self.device_type, self.index)
+    async def _request(self, cmd, *args):
+        """
+        Send a per-device command to the host and return the reply payload.
+        """
+        return await self._client._request('device.{}'.format(cmd), self.index, *args)
+
+    async def power_on(self):
+        """Power on the device."""
+        await self._request('power_on')
+    async def power_off(self):
+        """Power off the device."""
+        await self._request('power_off')
+    async def reset(self):
+        """Reset the device."""
+        await self._request('reset')
+    async def configure(self):
+        """Initialize and configure the device."""
+        await self._request('configure')
+    async def daq_start(self):
+        """Start data aquisition for the device."""
+        await self._request('daq_start')
+    async def daq_stop(self):
+        """Stop data aquisition for the device."""
+        await self._request('daq_stop')
+
+    async def list_registers(self):
+        """List all available registers by name."""
+        return (await self._request('list_registers')).decode('utf-8').split()
+    async def get_register(self, name):
+        """Get the value of a named register."""
+        return int(await self._request('get_register', name))
+    async def set_register(self, name, value):
+        """Set the value of a named register."""
+        await self._request('set_register', name, value)
+
+    async def set_memory_block(self, name, values):
+        """Write a block of 32-bit words to one named memory register, in order."""
+        # chunks are awaited one by one so they reach the register in order
+        for request in block_write_requests(name, values):
+            await self._request(*request)
+    async def get_memory_block(self, name, n):
+        """Read n 32-bit words from one named memory register, in order."""
+        replies = []
+        for request in block_read_requests(name, n):
+            replies.append(await self._request(*request))
+        return join_block_replies(replies)
+
+    async def get_current(self, name):
+        """Get the measured current of a named periphery port."""
+        return float(await self._request('get_current', name))
+    async def set_current(self, name, value, pol):
+        """Set the current of a named periphery port."""
+        await self._request('set_current', name, value, pol)
+
+    async def get_voltage(self, name):
+        """Get the measured voltage of a named periphery port."""
+        return float(await self._request('get_voltage', name))
+    async def set_voltage(self, name, value):
+        """Set the voltage of a named periphery port."""
+        await self._request('set_voltage', name, value)
+
+    async def switch_on(self, name):
+        """Switch on a periphery port."""
+        await self._request('switch_on', name)
+    async def switch_off(self, name):
+        """Switch off a periphery port."""
+        await self._request('switch_off', name)
+
+    # unknown attributes are interpreted as dynamic functions
+    # and are forwarded as-is to the pearyd instance
+    def __getattr__(self, name):
+        func = functools.partial(self._request, name)
+        self.__dict__[name] = func
+        return func
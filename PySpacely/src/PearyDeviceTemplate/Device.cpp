@@ -5,6 +5,9 @@
 #include "((devname))Device.hpp"
 #include "utils/log.hpp"
 
+#include <cstdio>
+#include <stdexcept>
+
 using namespace caribou;
 
 ((devname))Device::((devname))Device(const caribou::Configuration config)
@@ -18,6 +21,10 @@ using namespace caribou;
    // Add memory pages to the dictionary:
   _memory.add(FPGA_REGS);
 
+  // Block transfer commands used by Spacely's Caribou.set_memory_block() / get_memory_block()
+  _dispatcher.add("set_memory_block", &((devname))Device::setMemoryBlock, this);
+  _dispatcher.add("get_memory_block", &((devname))Device::getMemoryBlock, this);
+
 }
 
 void ((devname))Device::powerUp() {
@@ -42,6 +49,36 @@ void ((devname))Device::daqStop() {
   return;
 }
 
+void ((devname))Device::setMemoryBlock(const std::string& name, const std::string& words) {
+  if (words.size() % 8 != 0) {
+    throw std::invalid_argument("set_memory_block: payload is not a whole number of 32-bit words");
+  }
+
+  for (size_t i = 0; i < words.size(); i += 8) {
+    uintptr_t value = 0;
+    //Each word is 4 little-endian bytes, 2 hex characters per byte.
+    for (size_t b = 0; b < 4; b++) {
+      value |= std::stoul(words.substr(i + 2 * b, 2), nullptr, 16) << (8 * b);
+    }
+    setMemory(name, value);
+  }
+}
+
+std::string ((devname))Device::getMemoryBlock(const std::string& name, const size_t n) {
+  std::string words;
+  words.reserve(8 * n);
+  char hex[3];
+
+  for (size_t i = 0; i < n; i++) {
+    uintptr_t value = getMemory(name);
+    for (size_t b = 0; b < 4; b++) {
+      std::snprintf(hex, sizeof(hex), "%02x", static_cast<unsigned int>((value >> (8 * b)) & 0xff));
+      words += hex;
+    }
+  }
+  return words;
+}
+
 //Need to provide a definition for the destructor, or it will throw an error.
 ((devname))Device::~((devname))Device() {
   LOG(INFO) << "Shutdown, delete device.";
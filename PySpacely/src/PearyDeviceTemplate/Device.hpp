@@ -11,6 +11,7 @@
 #include "((devname))Defaults.hpp"
 
 #include <fstream>
+#include <string>
 
 namespace caribou {
 
@@ -28,6 +29,11 @@ namespace caribou {
     void powerUp() override;
     void powerDown() override;
 
+    // Block transfers: move many 32-bit words to/from one (FIFO-style) register
+    // in a single command. Words are little-endian, hex-encoded.
+    void setMemoryBlock(const std::string& name, const std::string& words);
+    std::string getMemoryBlock(const std::string& name, const size_t n);
+
   };
 
 
@@ -4,6 +4,8 @@ from datetime import datetime
 import os
 from os import stat
 import time
+from contextlib import contextmanager
+from concurrent.futures import Future
 
 WINDOWS_OS = ('nt' in os.name)
 
@@ -11,7 +13,7 @@ if not WINDOWS_OS:
     from pwd import getpwuid
     import fcntl
 
-from PearyClient import PearyClient, Device, Failure
+from PearyClient import PearyClient, Device, Failure, block_read_requests, block_write_requests, join_block_replies
 from VirtualCaribou import VirtualCaribouClient
 from fnal_libinstrument import Source_Instrument
 
@@ -178,6 +180,33 @@ SPACELY_MODULES_DEFAULT_REGS = {"Arbitrary_Pattern_Generator" : ["run","clear","
                                                            "run","status","loop_pattern","loop_pattern_len","loop_iters","loop_mode","loop_counter","param_MEM_DEPTH"]}
 
 
+# Registers which behave as FIFOs, i.e. every access moves data. These are never shadowed.
+SPACELY_FIFO_REGS = ["write_channel", "read_channel", "async_read_channel", "mem_write", "mem_read"]
+# Registers which trigger an action when written and clear themselves. Writing the same value
+# again is not a no-op, so these are never shadowed either.
+SPACELY_STROBE_REGS = ["run", "clear", "mem_write_ptr_reset", "mem_read_ptr_reset"]
+
+# Register types used by the Caribou shadow-register cache.
+SHADOW_RW = "rw"             # Read/write: writes of an unchanged value are skipped.
+SHADOW_WO = "wo"             # Write-only (trigger): every write is sent, reads are served from the cache.
+SHADOW_STATIC = "static"     # Read-only param_* registers: read from hardware once, then from the cache.
+SHADOW_VOLATILE = "volatile" # Status and FIFO registers: never cached.
+
+def shadow_reg_type(mem_name, mem_map_entry):
+    """Classify a register for the shadow-register cache based on its mem_map entry."""
+    if any(mem_name.endswith(fifo_reg) for fifo_reg in SPACELY_FIFO_REGS):
+        return SHADOW_VOLATILE
+    if mem_map_entry["Readable"] and mem_map_entry["Writeable"]:
+        if any(mem_name.endswith(strobe_reg) for strobe_reg in SPACELY_STROBE_REGS):
+            return SHADOW_VOLATILE
+        return SHADOW_RW
+    if mem_map_entry["Writeable"]:
+        return SHADOW_WO
+    if "param_" in mem_name:
+        return SHADOW_STATIC
+    return SHADOW_VOLATILE
+
+
 #class Device_emu(object):
 #    
 #    def __init__(self, client):
@@ -248,6 +277,13 @@ class Caribou(Source_Instrument):
         
         #List of AXI-addressable registers, to be used for running axi_shell
         self.axi_registers = None
+
+        #Shadow-register cache, see enable_shadow_registers(). None when disabled.
+        self.shadow = None
+        self._shadow_types = {}
+
+        #Register accesses queued by batch(). None when not batching.
+        self._batch = None
         
         self._dev = self._client.ensure_device(self._device_name)
 
@@ -328,17 +364,252 @@ class Caribou(Source_Instrument):
         
 
     def get_memory(self, mem_name):
-        """Return the contents of an FPGA Memory Register"""
-        return_val = int(self._dev.get_memory(mem_name))
+        """Return the contents of an FPGA Memory Register.
+           Inside a batch(), returns a Future which resolves when the batch is flushed."""
+        if self.shadow is not None:
+            reg_type = self._shadow_types.get(mem_name, SHADOW_VOLATILE)
+            if reg_type == SHADOW_WO and self._batch is not None:
+                #A write queued earlier in this batch is not in the shadow yet.
+                for future, _, cmd, args in reversed(self._batch):
+                    if cmd == "set_memory" and args[0] == mem_name:
+                        return self._gather_futures([future], lambda _, value=args[1]: value)
+            if reg_type in (SHADOW_WO, SHADOW_STATIC) and mem_name in self.shadow:
+                return_val = self.shadow[mem_name]
+                if self.debug_memory:
+                    self.log.debug(f"<AXI> Read {mem_name}: {return_val} (shadow)")
+                return self._batch_result(return_val)
+
+        if self._batch is not None:
+            return self._queue_request(self._finish_get_memory, "get_memory", mem_name)
+        return self._finish_get_memory(self._dev.get_memory(mem_name), mem_name)
+
+    def _finish_get_memory(self, reply, mem_name):
+        """Decode the reply to a get_memory command."""
+        return_val = int(reply)
         if self.debug_memory:
             self.log.debug(f"<AXI> Read {mem_name}: {return_val}")
+
+        if self.shadow is not None and self._shadow_types.get(mem_name, SHADOW_VOLATILE) != SHADOW_VOLATILE:
+            self.shadow[mem_name] = return_val
         return return_val
 
     def set_memory(self, mem_name, value):
-        """Set the contents of an FPGA Memory Register"""
+        """Set the contents of an FPGA Memory Register.
+           Inside a batch(), returns a Future which resolves when the batch is flushed."""
+        if self.shadow is not None:
+            reg_type = self._shadow_types.get(mem_name, SHADOW_VOLATILE)
+            if reg_type == SHADOW_RW and self.shadow.get(mem_name) == value:
+                if self.debug_memory:
+                    self.log.debug(f"<AXI> Set {mem_name} = {value} (skipped, unchanged)")
+                return self._batch_result(None)
+            #The shadow is only updated once the write has reached hardware, see _finish_set_memory().
+            self.shadow.pop(mem_name, None)
+
         if self.debug_memory:
             self.log.debug(f"<AXI> Set {mem_name} = {value}")
-        return self._dev.set_memory(mem_name,value)
+        if self._batch is not None:
+            return self._queue_request(self._finish_set_memory, "set_memory", mem_name, value)
+        return self._finish_set_memory(self._dev.set_memory(mem_name,value), mem_name, value)
+
+    def _finish_set_memory(self, reply, mem_name, value):
+        """Record a successful set_memory command in the shadow."""
+        if self.shadow is not None and self._shadow_types.get(mem_name, SHADOW_VOLATILE) in (SHADOW_RW, SHADOW_WO):
+            self.shadow[mem_name] = value
+        return reply
+
+    @contextmanager
+    def batch(self):
+        """Context manager which defers register accesses and sends them all at once.
+
+           Inside the with block, set_memory() and get_memory() are queued instead of
+           being sent, and return Futures. When the block exits, the queued commands
+           are sent back to back, in order, as one pipelined transfer, and the Futures
+           resolve. If the block raises, the queue is discarded without sending anything.
+
+           Example:
+               with car.batch():
+                   car.set_memory("spi_transaction_len", 32)
+                   car.set_memory("spi_run", 1)
+                   status = car.get_memory("spi_status")
+               print(status.result())
+
+           Reads inside a batch see the register state at flush time, so a batch
+           cannot branch on a value it reads. Nested batches join the outermost one.
+        """
+        if self._batch is not None:
+            yield
+            return
+
+        self._batch = []
+        try:
+            yield
+        except BaseException:
+            queued = self._batch
+            self._batch = None
+            for future, _, _, _ in queued:
+                future.cancel()
+            raise
+
+        queued = self._batch
+        self._batch = None
+        self._flush_batch(queued)
+
+    def _queue_request(self, finish, cmd, *args):
+        """Queue a device command in the current batch. finish(reply, *args) decodes the reply."""
+        future = Future()
+        self._batch.append((future, finish, cmd, args))
+        return future
+
+    def _batch_result(self, value):
+        """Return value, or a completed Future for value when inside a batch."""
+        if self._batch is None:
+            return value
+        future = Future()
+        future.set_result(value)
+        return future
+
+    def _gather_futures(self, futures, combine):
+        """Return a Future which resolves to combine(results) once all of futures are done.
+           If any of them failed, it fails with the first failure, in order."""
+        outer = Future()
+        remaining = [len(futures)]
+
+        def done(_):
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+            for f in futures:
+                if f.cancelled():
+                    outer.cancel()
+                    return
+                if f.exception() is not None:
+                    outer.set_exception(f.exception())
+                    return
+            try:
+                outer.set_result(combine([f.result() for f in futures]))
+            except Exception as e:
+                outer.set_exception(e)
+
+        for f in futures:
+            f.add_done_callback(done)
+        return outer
+
+    def _flush_batch(self, queued):
+        """Send queued batch commands as one pipelined transfer and resolve their Futures."""
+        if len(queued) == 0:
+            return
+
+        if self.debug_memory:
+            self.log.debug(f"<AXI> Flushing batch of {len(queued)} commands")
+
+        try:
+            replies = self._dev._request_pipelined([(cmd,) + args for _, _, cmd, args in queued], return_exceptions=True)
+        except Exception as e:
+            #The connection failed, so it is unknown which commands reached hardware.
+            for future, _, _, _ in queued:
+                future.set_exception(e)
+            raise
+
+        first_failure = None
+        for (future, finish, cmd, args), reply in zip(queued, replies):
+            if isinstance(reply, Failure):
+                self.log.error(f"PearyClient Failure: Command '{reply.cmd}' failed with Code {reply.code} ({reply.reason})")
+                future.set_exception(reply)
+                if first_failure is None:
+                    first_failure = reply
+            elif finish is not None:
+                try:
+                    future.set_result(finish(reply, *args))
+                except Exception as e:
+                    future.set_exception(e)
+            else:
+                future.set_result(reply)
+
+        if first_failure is not None:
+            raise first_failure
+
+    def get_memory_block(self, mem_name, n):
+        """Read n words from one FPGA Memory Register (FIFO-style, e.g. a read_channel)
+           in a single message. Returns an array('I') of the words read.
+           Inside a batch(), returns a Future which resolves when the batch is flushed."""
+        if self.debug_memory:
+            self.log.debug(f"<AXI> Read {n} words from {mem_name}")
+
+        if self._batch is not None:
+            requests = block_read_requests(mem_name, n)
+            if len(requests) == 0:
+                return self._batch_result(join_block_replies([]))
+            #Queue one request per chunk, and join them once they are all done.
+            chunks = [self._queue_request(None, *req) for req in requests]
+            return self._gather_futures(chunks, join_block_replies)
+        
+        return self._dev.get_memory_block(mem_name, n)
+
+    def set_memory_block(self, mem_name, values):
+        """Write a sequence of words to one FPGA Memory Register (FIFO-style, e.g. a
+           write_channel) in a single message. values may be a list, NumPy array or
+           little-endian packed bytes.
+           Inside a batch(), returns a Future which resolves when the batch is flushed."""
+        if self.debug_memory:
+            self.log.debug(f"<AXI> Write block to {mem_name}")
+        if self.shadow is not None:
+            self.shadow.pop(mem_name, None)
+
+        if self._batch is not None:
+            chunks = [self._queue_request(None, *req) for req in block_write_requests(mem_name, values)]
+            if len(chunks) == 0:
+                return self._batch_result(None)
+            return self._gather_futures(chunks, lambda _: None)
+        
+        return self._dev.set_memory_block(mem_name, values)
+
+    def enable_shadow_registers(self, mem_map):
+        """Enable the shadow-register cache.
+
+           With the cache enabled, Caribou remembers the last value written to each
+           register. Writes to read/write registers which would not change their value
+           are skipped, and reads of write-only and static (param_*) registers are
+           served from the cache. FIFO, strobe (e.g. APG run/clear) and read-only
+           status registers always go to hardware.
+
+           The cache assumes nothing but this object writes the registers. After a
+           firmware reset or a write made some other way, call invalidate_shadow().
+
+           Arguments:
+           mem_map -- Memory map dict from parse_mem_map(), or the filename of a mem_map.txt
+        """
+        if type(mem_map) == str:
+            with open(mem_map,'r') as read_file:
+                mem_map = parse_mem_map(read_file.readlines())
+
+        if mem_map == -1:
+            self.log.error("Shadow registers could not be enabled due to previous mem_map parse error.")
+            return -1
+
+        self._shadow_types = {mem_name : shadow_reg_type(mem_name, mem_map[mem_name]) for mem_name in mem_map.keys()}
+        self.shadow = {}
+
+    def disable_shadow_registers(self):
+        """Disable the shadow-register cache, so every access goes to hardware."""
+        self.shadow = None
+
+    def invalidate_shadow(self, reg_type=None, mem_name=None):
+        """Forget shadowed register values so they are next read from / written to hardware.
+
+           Arguments:
+           reg_type -- Only forget registers of this type (SHADOW_RW, SHADOW_WO or SHADOW_STATIC)
+           mem_name -- Only forget this register
+           With no arguments, the whole cache is cleared.
+        """
+        if self.shadow is None:
+            return
+
+        for name in list(self.shadow.keys()):
+            if reg_type is not None and self._shadow_types.get(name) != reg_type:
+                continue
+            if mem_name is not None and name != mem_name:
+                continue
+            del self.shadow[name]
 
     def dly_min_axi_clk(self, clk_cycles):
         """Ensure a delay of a minimum number of AXI clock cycles."""
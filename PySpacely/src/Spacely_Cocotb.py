@@ -1,5 +1,8 @@
 import os
 import re
+from array import array
+from contextlib import contextmanager
+from concurrent.futures import Future
 
 import cocotb
 import logging
@@ -12,6 +15,7 @@ import Spacely_Globals as sg
 from Spacely_Utils import *
 
 from Spacely_Caribou import parse_mem_map
+from PearyClient import unpack_words
 
 
 def add_hdl_path(filename):
@@ -672,6 +676,9 @@ class CaribouTwin(Source_Instrument):
         self.mem_map = {}
 
         self.debug_memory = False
+
+        # Nesting depth of batch() blocks.
+        self._batch_depth = 0
   
         sg.log.debug(">>  Setting up AXI Interfaces based on mem_map.txt")
         self._setup_axi(mem_map_file)
@@ -816,7 +823,9 @@ class CaribouTwin(Source_Instrument):
             cocotb.function(self.axi[iface_num].write_dword)(reg_offs,value, byteorder='little')
         except IndexError:
             sg.log.error(f"CaribouTwin: Tried to access axi interface #{iface_num}, but it doesn't exist. Only {len(self.axi)} axi interfaces have been initialized.")
-            return -1
+            return self._batch_result(-1)
+
+        return self._batch_result(None)
 
     def get_memory(self, mem_name):
         try:
@@ -836,8 +845,47 @@ class CaribouTwin(Source_Instrument):
 
         if self.debug_memory:
             sg.log.debug(f"<AXI> Read {mem_name}: {x}")
-        return x
-
+        return self._batch_result(x)
+
+
+    def set_memory_block(self, mem_name, values):
+        """Write a sequence of words to one register, one AXI write per word."""
+        if isinstance(values, (bytes, bytearray, memoryview)):
+            values = unpack_words(values)
+        with self.batch():
+            for value in values:
+                if self.set_memory(mem_name, int(value)).result() == -1:
+                    return self._batch_result(-1)
+        return self._batch_result(None)
+
+    def get_memory_block(self, mem_name, n):
+        """Read n words from one register, one AXI read per word. Returns an array('I'),
+           like Caribou.get_memory_block()."""
+        with self.batch():
+            samples = [self.get_memory(mem_name).result() for _ in range(n)]
+        if -1 in samples:
+            return self._batch_result(-1)
+        return self._batch_result(array('I', samples))
+
+    @contextmanager
+    def batch(self):
+        """Same interface as Caribou.batch(), so pattern runners can batch register
+           accesses without knowing which backend they use. The twin has no round-trip
+           to save, so accesses still happen immediately; inside the block they
+           return completed Futures."""
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+
+    def _batch_result(self, value):
+        """Return value, or a completed Future for value when inside a batch."""
+        if self._batch_depth == 0:
+            return value
+        future = Future()
+        future.set_result(value)
+        return future
 
     async def dly_min_axi_clk_async(self,clk_cycles):
         await ClockCycles(self.dut.AXI_ACLK,clk_cycles)
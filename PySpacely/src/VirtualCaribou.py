@@ -6,7 +6,7 @@
 # for testing & debug of Spacely-Caribou software without actually running on hardware.
 # VirtualCaribouClient mimics the interface of the PearyClient class which actually connects to hardware.
 
-from PearyClient import Device
+from PearyClient import Device, Failure, pack_words, unpack_words
 
 class VirtualCaribouException(Exception):
     pass
@@ -34,6 +34,25 @@ class VirtualCaribouClient:
             self._log.debug(f"peary_emu sending cmd: {req_payload}")
         
         return self.vc.peary_cmd(req_payload)
+
+    def _request_pipelined(self, requests, return_exceptions=False):
+        """
+        Emulated pipelining: requests are simply executed one after the other.
+        Like PearyClient, every request is executed even if an earlier one failed,
+        and failures are reported as Failure objects.
+        """
+        results = []
+        for req in requests:
+            try:
+                results.append(self._request(*req))
+            except VirtualCaribouException as e:
+                results.append(Failure(req[0], 1, str(e).encode('utf-8')))
+
+        if not return_exceptions:
+            for result in results:
+                if isinstance(result, Failure):
+                    raise result
+        return results
         
         
     def keep_alive(self):
@@ -121,6 +140,10 @@ class VirtualCaribou:
             return self.device_set_memory(args)
         elif command == "device.get_memory":
             return self.device_get_memory(args)
+        elif command == "device.set_memory_block":
+            return self.device_set_memory_block(args)
+        elif command == "device.get_memory_block":
+            return self.device_get_memory_block(args)
         else:
             self._log.warning(f"VirtualCaribou: Ignoring unrecognized Command \"{command}\"")
     
@@ -142,6 +165,21 @@ class VirtualCaribou:
         else:
             raise VirtualCaribouException(f"{args[0]} is not a valid register!")
     
+    def device_set_memory_block(self,args):
+        if len(args) < 2:
+            raise VirtualCaribouException(f"device.set_memory_block has fewer than two args ('{args}')")
+        
+        #Registers are emulated as plain storage, so a block write leaves the last word.
+        for word in unpack_words(bytes.fromhex(args[1])):
+            self.device_set_memory([args[0], word])
+    
+    def device_get_memory_block(self,args):
+        if len(args) < 2:
+            raise VirtualCaribouException(f"device.get_memory_block has fewer than two args ('{args}')")
+        
+        words = [self.device_get_memory(args[:1]) for _ in range(int(args[1]))]
+        return pack_words(words).hex()
+    
     def device_get_voltage(self, args):
         if args[0] in self.vout.keys():
             return self.vout[args[0]]
@@ -2,6 +2,14 @@
 
 import serial
 import time
+import os
+import asyncio
+import numpy as np
+try:
+    import termios
+except ImportError:
+    # Windows; AsyncHal is not available.
+    termios = None
 from si_prefix import si_format
 
 ### FUNCTIONS ###
@@ -49,7 +57,7 @@ def command_ng(log, port, cmd_txt, data_timeout=0.2) -> str:
         raise IOError("Port is closed")
     
     if "*" in cmd_txt:
-       raise Exception("Streaming mode not supported (yet)")
+       raise Exception("Streaming commands must be run with command_stream()")
     
     while port.out_waiting > 0: # on Windows, the OS may double-buffer data; we need to wait for it!
         pass
@@ -93,6 +101,281 @@ def command_ng(log, port, cmd_txt, data_timeout=0.2) -> str:
     # remove HAL protocol markers while joinng the list in *new memory* space
     return ''.join(lines).strip('\r\n?')
 
+def _strip_echo(response: str, cmd_txt: str) -> str:
+    # With echo:on the HAL repeats the command before its output.
+    if response.startswith(cmd_txt):
+        response = response[len(cmd_txt):]
+    return response.strip('\r\n?')
+
+def command_ng_array(log, port, cmd_txt, data_timeout=0.2) -> np.ndarray:
+    """Like command_ng(), but parses the whitespace-separated integers the HAL sends back
+       (e.g. for conv100x or convNx:<N>) straight into a NumPy int array.
+       Raises ValueError if the response holds anything other than integers."""
+    r = _strip_echo(command_ng(log, port, cmd_txt, data_timeout), cmd_txt)
+    values = np.array(r.split(), dtype=np.int64)
+    log.debug(f"HAL RX parsed {len(values)} values")
+    return values
+
+def command_ng_bits(log, port, cmd_txt, data_timeout=0.2) -> np.ndarray:
+    """Like command_ng(), but returns a run of '0'/'1' characters the HAL sends back
+       (e.g. for cdac100x:<code>) as a NumPy uint8 array of 0s and 1s."""
+    r = _strip_echo(command_ng(log, port, cmd_txt, data_timeout), cmd_txt).strip()
+    return np.frombuffer(r.encode('ascii'), dtype=np.uint8) - ord('0')
+
+def command_stream(log, port, cmd_txt, parse=None, idle_timeout_s=None, stop_timeout_s=2):
+    """Sends a HAL command and yields its output line by line, as it arrives. Works for
+       streaming ("*") commands as well as ordinary ones.
+
+       parse -- optional function applied to each line (e.g. int); lines it rejects with
+                ValueError are skipped. Without it, lines are yielded as str.
+       idle_timeout_s -- give up if the HAL sends nothing for this long (None = wait forever).
+
+       The generator ends when the HAL prints its "?" prompt (or, in binary mode, sends
+       a prompt frame). HAL comments ("?#...") are
+       logged instead of yielded. If the caller stops early (break, close(), Ctrl-C), the
+       stream is stopped cleanly: a newline is sent and the HAL's output is drained up to
+       its prompt, so the next command starts from a clean state.
+       """
+    log.debug(f"TX HAL streaming command: {cmd_txt}")
+    if not port.is_open:
+        raise IOError("Port is closed")
+
+    old_timeout = port.timeout
+    port.timeout = 0.05
+    port.write(cmd_txt.encode('ascii'))
+
+    buf = bytearray()
+    last_rx_time = time.perf_counter()
+    finished = False
+    
+    try:
+        while not finished:
+            # Block briefly for the first byte, then take everything that has arrived.
+            data = port.read(max(1, port.in_waiting))
+
+            if data:
+                last_rx_time = time.perf_counter()
+                buf += data
+            elif _prompt_len(buf):
+                # Prompt, and nothing after it: the HAL is done. The last line
+                # may not have ended with a newline before the prompt.
+                finished = True
+                prompt_len = _prompt_len(buf)
+                buf = buf[:-prompt_len] + b'\n' if len(buf) > prompt_len else bytearray()
+            elif idle_timeout_s is not None and time.perf_counter() - last_rx_time > idle_timeout_s:
+                log.warning(f"HAL sent nothing for {idle_timeout_s} s, stopping stream")
+                return
+
+            *lines, rest = buf.split(b'\n')
+            buf = bytearray(rest)
+            
+            for line in lines:
+                line = line.decode('ascii', errors='replace').rstrip('\r')
+                
+                if line.startswith('?#'):
+                    log.info(f"HAL comment: {line[2:]}")
+                    continue
+                
+                if parse is None:
+                    yield line
+                else:
+                    try:
+                        yield parse(line)
+                    except ValueError:
+                        log.debug(f"Skipping unparseable HAL line >>{line}<<")
+    finally:
+        if not finished:
+            stop_stream(log, port, stop_timeout_s)
+        port.timeout = old_timeout
+
+
+def stop_stream(log, port, timeout_s=2):
+    """Stops a streaming HAL command by sending a newline, then discards the HAL's
+       output up to its next "?" prompt."""
+    port.write(b"\n")
+    port.timeout = 0.05
+    start_time = time.perf_counter()
+    
+    buf = bytearray()
+    while time.perf_counter() - start_time < timeout_s:
+        data = port.read(max(1, port.in_waiting))
+        if data:
+            buf += data
+        elif _prompt_len(buf):
+            log.debug(f"HAL stream stopped ({len(buf)}B discarded)")
+            return True
+
+    log.warning(f"HAL did not return to its prompt within {timeout_s} s of stopping the stream")
+    return False
+
+
+def _parse_hist_line(line):
+    code, count = line.split(',')
+    return int(code), int(count)
+
+def command_hist(log, port, points, idle_timeout_s=60) -> dict[int, int]:
+    """Takes a number of conversions with the HAL's histNx command, which builds the histogram
+       of output codes on the MCU and sends back only the non-empty bins.
+       Returns a dictionary where keys are output codes, and values are their counts.
+
+       idle_timeout_s -- the HAL is silent while it converts, so this must cover the whole
+                         acquisition (None = wait forever).
+
+       Raises IOError if the HAL rejects histNx (in binary mode, or on an UNO)."""
+    start_time = time.perf_counter()
+    histogram = {}
+    error = None
+    for line in command_stream(log, port, f"histNx:{points}", idle_timeout_s=idle_timeout_s):
+        # Keep reading up to the prompt before raising, so the next command starts clean.
+        if line.startswith("ERR"):
+            error = line
+            continue
+        try:
+            code, count = _parse_hist_line(line)
+        except ValueError:
+            log.debug(f"Skipping unparseable HAL line >>{line}<<")
+            continue
+        histogram[code] = count
+
+    if error is not None:
+        raise IOError(f"HAL histNx failed: {error}")
+
+    total = sum(histogram.values())
+    log.debug(f"HAL histogram: {total} conversions in {len(histogram)} bins ({time.perf_counter() - start_time:.2f} s)")
+    if total != points:
+        log.warning(f"HAL histogram has {total} conversions, expected {points}")
+
+    return histogram
+
+
+### BINARY FRAMED MODE ###
+# After "bin:on", the HAL sends bulk data as binary frames (see generic_hal.h):
+#    SYNC (0xA5) | TYPE (1B) | LEN (2B LE) | PAYLOAD (LEN bytes) | CHECKSUM (2B LE)
+# where CHECKSUM is the Fletcher-16 of TYPE, LEN and PAYLOAD. Plain ASCII text may still
+# appear between frames, and the "?" prompt is replaced by a HAL_FRAME_PROMPT frame.
+HAL_FRAME_SYNC = 0xA5
+HAL_FRAME_PROMPT = 0x01
+HAL_FRAME_U16 = 0x02
+
+HAL_FRAME_HEADER_LEN = 4
+HAL_FRAME_CHECKSUM_LEN = 2
+
+def fletcher16(data) -> int:
+    """Fletcher-16 checksum of data, as (sum2 << 8) | sum1."""
+    d = np.frombuffer(bytes(data), dtype=np.uint8).astype(np.int64)
+    sum1 = int(d.sum()) % 255
+    # sum2 is the sum of the running sums, i.e. byte i is counted (len-i) times.
+    sum2 = int((d * np.arange(len(d), 0, -1)).sum()) % 255
+    return (sum2 << 8) | sum1
+
+# A whole (empty) HAL_FRAME_PROMPT frame, as it appears on the wire.
+HAL_PROMPT_FRAME = (bytes([HAL_FRAME_SYNC, HAL_FRAME_PROMPT, 0, 0])
+                    + fletcher16([HAL_FRAME_PROMPT, 0, 0]).to_bytes(HAL_FRAME_CHECKSUM_LEN, 'little'))
+
+def _prompt_len(buf) -> int:
+    """Length of the prompt at the end of buf ("?", or a prompt frame in binary mode), or 0."""
+    if buf.endswith(b'?'):
+        return 1
+    if buf.endswith(HAL_PROMPT_FRAME):
+        return len(HAL_PROMPT_FRAME)
+    return 0
+
+
+class HalFrameParser():
+    """Splits the byte stream from a HAL in binary mode into plain text and frames."""
+    
+    def __init__(self, log):
+        self.log = log
+        self._buf = bytearray()
+
+    def feed(self, data) -> list:
+        """Adds received bytes. Returns a list of (frame_type, payload) for every complete
+           frame, with frame_type None for plain text that arrived between frames."""
+        self._buf += data
+        items = []
+        
+        while True:
+            sync = self._buf.find(HAL_FRAME_SYNC)
+            if sync == -1:
+                sync = len(self._buf)
+            if sync > 0:
+                items.append((None, bytes(self._buf[:sync])))
+                del self._buf[:sync]
+
+            if len(self._buf) < HAL_FRAME_HEADER_LEN:
+                break
+
+            frame_len = HAL_FRAME_HEADER_LEN + int.from_bytes(self._buf[2:4], 'little') + HAL_FRAME_CHECKSUM_LEN
+            if len(self._buf) < frame_len:
+                break
+
+            checksum = int.from_bytes(self._buf[frame_len-HAL_FRAME_CHECKSUM_LEN:frame_len], 'little')
+            if fletcher16(self._buf[1:frame_len-HAL_FRAME_CHECKSUM_LEN]) != checksum:
+                # Skip this SYNC byte and look for the next frame.
+                self.log.error(f"HAL frame checksum mismatch (type={self._buf[1]}, {frame_len}B), dropping it")
+                del self._buf[:1]
+                continue
+            
+            items.append((self._buf[1], bytes(self._buf[HAL_FRAME_HEADER_LEN:frame_len-HAL_FRAME_CHECKSUM_LEN])))
+            del self._buf[:frame_len]
+
+        return items
+
+
+def command_bin(log, port, cmd_txt, timeout_s=5):
+    """Sends a command to a HAL in binary framed mode and reads its response up to the next prompt.
+       Returns (text, data), where text is the plain-text output and data is a NumPy uint16 array
+       of the values from all HAL_FRAME_U16 frames, in order."""
+    log.debug(f"TX HAL command (binary mode): {cmd_txt}")
+    if not port.is_open:
+        raise IOError("Port is closed")
+
+    old_timeout = port.timeout
+    port.timeout = 0.1
+    port.write(cmd_txt.encode('ascii'))
+    start_time = time.perf_counter()
+
+    parser = HalFrameParser(log)
+    text = bytearray()
+    payloads = []
+    got_prompt = False
+    
+    try:
+        while not got_prompt:
+            # Block for the first byte, then take everything that has arrived.
+            data = port.read(max(1, port.in_waiting))
+
+            for frame_type, payload in parser.feed(data):
+                if frame_type is None:
+                    text += payload
+                elif frame_type == HAL_FRAME_U16:
+                    payloads.append(payload)
+                elif frame_type == HAL_FRAME_PROMPT:
+                    got_prompt = True
+                else:
+                    log.warning(f"Ignoring HAL frame of unknown type {frame_type}")
+
+            if not got_prompt and time.perf_counter() - start_time > timeout_s:
+                log.warning(f"Timed out after {timeout_s} s waiting for the HAL prompt")
+                break
+    finally:
+        port.timeout = old_timeout
+
+    data = np.frombuffer(b''.join(payloads), dtype='<u2')
+    log.debug(f"HAL RX {len(text)}B text, {len(data)} values in {len(payloads)} frames")
+    
+    return text.decode('ascii', errors='replace').strip('\r\n'), data
+
+
+def set_binary_mode(log, port, enable: bool):
+    """Turns the HAL's binary framed mode on or off. While it is on, use command_bin()."""
+    if enable:
+        # The prompt after "bin:on" is already a frame.
+        command_bin(log, port, "bin:on")
+    else:
+        command_ng(log, port, "bin:off")
+
+
 def command(port, cmd_txt, printresponse=True, timeout_s=0.2):
 
     print(f"Sending cmd: {cmd_txt}")
@@ -102,64 +385,193 @@ def command(port, cmd_txt, printresponse=True, timeout_s=0.2):
     else:
         stream_data = 0
 
-    response_str=""
-    last_newline = 0
+    response = bytearray()  # everything received so far, except comments
+    pending = bytearray()   # received but not yet sorted into response / comment
+    printed_len = 0         # length of response which has already been printed
+
+    receiving_comment = False
+    comment_contents = bytearray()
 
     port.write(bytes(cmd_txt+"\n",'utf-8'))
     write_time = time.perf_counter()
-    
-    receiving_comment = False
-    comment_contents = ''
 
-    #Every time we get a command, we will give it 200 ms to come up
-    #with additional output before bailing.
-    while stream_data or (time.perf_counter()-write_time < timeout_s): 
-        try:
-            #If there's nothing new for us after 100 ms, we break.
-            #if not (port.in_waiting or stream_data) \
-            #   and :
-            #    break
-            #If there is, we read it and then wait for more.
-            if response_str[-2:]=='\n?':
+    old_timeout = port.timeout
+    # Block for at most 10 ms per read, so we notice the timeout without spinning.
+    port.timeout = 0.01
+
+    try:
+        #Every time we get a command, we will give it 200 ms to come up
+        #with additional output before bailing.
+        while stream_data or (time.perf_counter()-write_time < timeout_s): 
+            try:
+                if response[-2:] == b'\n?' and not port.in_waiting:
+                    break
+
+                # Read everything that has arrived in one go.
+                pending += port.read(max(1, port.in_waiting))
+
+                while len(pending) > 0:
+                    if receiving_comment:
+                        newline = pending.find(b'\n')
+                        if newline == -1:
+                            comment_contents += pending
+                            pending.clear()
+                        else:
+                            comment_contents += pending[:newline]
+                            del pending[:newline+1]
+                            #Start a new line if a prompt was just printed.
+                            if printresponse and printed_len > 0 and response[printed_len-1] != ord('\n'):
+                                print()
+                            print(f"GOT HAL COMMENT >>{str(comment_contents,'UTF-8',errors='replace')}<<")
+                            comment_contents.clear()
+                            receiving_comment = False
+                        continue
+
+                    # A "#" straight after a "?" prompt starts a comment, which lasts until the next newline.
+                    if (response == b'?' or response[-2:] == b'\n?') and pending[0] == ord('#'):
+                        receiving_comment = True
+                        del pending[:1]
+                        continue
+
+                    # Move everything up to and including the next "?" into the response,
+                    # so the check above sees every prompt.
+                    prompt = pending.find(b'?')
+                    take = len(pending) if prompt == -1 else prompt+1
+                    response += pending[:take]
+                    del pending[:take]
+
+                #Batch printing by newlines.
+                if printresponse:
+                    line_end = max(response.rfind(b'\n'), response.rfind(b'?')) + 1
+                    if line_end > printed_len:
+                        print(str(response[printed_len:line_end],'UTF-8',errors='replace'),end='')
+                        printed_len = line_end
+
+            except KeyboardInterrupt:
+                print("Ctrl-C detected! Sending a return to pause streaming data.")
+                port.write(bytes("\n",'utf-8'))
                 break
-            while port.in_waiting or stream_data:
-                print(f"READING SERIAL... piw={port.in_waiting} sd={stream_data}")
-                new_char = str(port.read(),'UTF-8')
-                print(f"GOT CHAR >>{new_char}<< incmt:{receiving_comment} buf_size:{len(response_str)}")
-                
-                if receiving_comment:
-                    if new_char == "\n":
-                        print("HAL NO LONGER IN COMMENT MODE")
-                        print(f"GOT HAL COMMENT >>{comment_contents}<<")
-                        comment_contents = ''
-                        receiving_comment = False
-                    else:
-                        comment_contents = f"{comment_contents}{new_char}"
-                    continue
-                    
-                if (response_str == '?' or response_str[-2:] == '\n?') and new_char == '#':
-                    print("HAL IN COMMENT MODE")
-                    receiving_comment = True
+    finally:
+        port.timeout = old_timeout
+
+    return str(response,'UTF-8',errors='replace')
+
+class AsyncHal():
+    """asyncio transport for the HAL, so HAL commands can share an event loop with other
+       work (e.g. instrument polling) instead of busy-waiting on the serial port.
+
+       Linux/POSIX only: the serial port's file descriptor is registered with the event
+       loop, reads happen only when the loop reports data is ready, and writes are
+       non-blocking. Usage:
+
+           port = open_port(serial_port, baud)
+           async with AsyncHal(log, port) as hal:
+               r = await hal.command("PING")
+       """
+
+    def __init__(self, log, port):
+        if termios is None:
+            raise OSError("AsyncHal needs a POSIX serial port; use command_ng() on Windows")
+        
+        self.log = log
+        self.port = port
+        self._fd = port.fileno()
+        self._loop = None
+        self._rx = bytearray()
+        self._rx_event = None
+        self._lock = None
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def start(self):
+        """Starts watching the port for data. Must be called from within the event loop."""
+        self._loop = asyncio.get_running_loop()
+        self._rx_event = asyncio.Event()
+        self._lock = asyncio.Lock()
+        # pyserial expects a blocking fd, so close() puts the original flag back.
+        self._was_blocking = os.get_blocking(self._fd)
+        os.set_blocking(self._fd, False)
+        # Discard stale input such as an old prompt, so it is not taken as the end of
+        # the first command's response.
+        termios.tcflush(self._fd, termios.TCIFLUSH)
+        self._loop.add_reader(self._fd, self._on_readable)
+
+    def close(self):
+        """Stops watching the port. The port itself is left open, in blocking mode again
+           if it was before start(), so it can go back to command_ng() and friends."""
+        if self._loop is not None:
+            self._loop.remove_reader(self._fd)
+            self._loop = None
+            os.set_blocking(self._fd, self._was_blocking)
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.log.error(f"HAL serial read failed: {e}")
+            self.close()
+            return
+        
+        self._rx += data
+        self._rx_event.set()
+
+    async def _write(self, data):
+        view = memoryview(data)
+        while len(view) > 0:
+            try:
+                view = view[os.write(self._fd, view):]
+            except BlockingIOError:
+                pass
+            
+            if len(view) > 0:
+                # Wait until the port can take more.
+                writable = self._loop.create_future()
+                self._loop.add_writer(self._fd, writable.set_result, None)
+                try:
+                    await writable
+                finally:
+                    self._loop.remove_writer(self._fd)
+
+    async def command(self, cmd_txt, timeout_s=5) -> str:
+        """Sends a HAL command and returns its response, like command_ng(). Returns as soon
+           as the HAL prints its "?" prompt, or after timeout_s without one."""
+        if "*" in cmd_txt:
+            raise Exception("Streaming commands are not supported by AsyncHal")
+
+        async with self._lock:
+            self.log.debug(f"TX HAL command: {cmd_txt}")
+            
+            # Drop anything stale left over from a previous command.
+            self._rx.clear()
+            self._rx_event.clear()
+            
+            await self._write(cmd_txt.encode('ascii'))
+
+            deadline = self._loop.time() + timeout_s
+            while not (self._rx == b'?' or self._rx.endswith(b'\n?')):
+                remaining = deadline - self._loop.time()
+                if remaining <= 0:
+                    self.log.warning(f"HAL prompt not received within {timeout_s} s (got {len(self._rx)} bytes)")
+                    break
+                try:
+                    await asyncio.wait_for(self._rx_event.wait(), remaining)
+                except asyncio.TimeoutError:
                     continue
-                    
-                
-                response_str = response_str + new_char
-                
-                has_new_line = ("\n" in new_char or "?" in new_char)
+                self._rx_event.clear()
+
+            response = self._rx.decode('ascii', errors='replace')
+            self._rx.clear()
+            
+        self.log.debug(f"HAL RX {len(response)}B")
+        return response.strip('\r\n?')
 
-                #Batch printing by newlines.
-                if printresponse and has_new_line:   
-                    print(response_str[last_newline:],end='')
-                    last_newline = len(response_str)
-                    
-
-        except KeyboardInterrupt:
-            print("Ctrl-C detected! Sending a return to pause streaming data.")
-            port.write(bytes("\n",'utf-8'))
-            break
-    
-#    print(f"Got response >>{response_str}<<")
-    return response_str
 
 def handshake_with_arduino_ng(log, port) -> bool:
     handshake_in = "PING"
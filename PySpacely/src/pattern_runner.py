@@ -3,13 +3,65 @@ import fnal_log_wizard as liblog
 from abc import ABC
 import os
 import time
-from threading import Thread
+import hashlib
+import functools
+from threading import Barrier
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+#####################################################################
+##                PATTERN PREPARATION                              ##
+#####################################################################
+
+class PreparedPattern:
+    """A GlueWave whose vector has been converted to a NumPy array and time-scaled,
+       ready to be handed to a bulk transfer (APG block write, NI FIFO write).
+
+       The original GlueWave is not modified. Attributes other than vector, len and
+       tsf (hardware, hardware_str, fpga_name, ...) are read from it.
+    """
+
+    def __init__(self, glue_wave, tsf=1, dtype=np.uint32):
+        self.glue_wave = glue_wave
+        self.tsf = tsf
+
+        vector = np.asarray(glue_wave.vector, dtype=dtype)
+        
+        #Built-in method to slow down the pattern by a factor of tsf
+        if tsf != 1:
+            vector = np.repeat(vector, tsf)
+
+        self.vector = vector
+        self.len = len(vector)
+
+    def digest(self, target=""):
+        """Returns a content hash of the prepared vector (including tsf), combined
+           with the name of the hardware target it is uploaded to."""
+        h = hashlib.sha1(self.vector.tobytes())
+        h.update(f"|{self.vector.dtype}|{self.tsf}|{target}".encode())
+        return h.hexdigest()
+
+    def __getattr__(self, name):
+        if name == "glue_wave":
+            raise AttributeError(name)
+        return getattr(self.glue_wave, name)
 
 
 #####################################################################
 ##                CARIBOU PATTERN RUNNER                           ##
 #####################################################################
 
+# Sample clock of the Spacely-Caribou Arbitrary Pattern Generator.
+APG_CLOCK_FREQUENCY = 10e6
+
+# Polling interval limits for CaribouPatternRunner.apg_wait_for_idle()
+APG_POLL_MIN_S = 1e-3
+APG_POLL_MAX_S = 0.1
+
+# Default time to wait for an APG to go idle, on top of the expected pattern duration.
+APG_IDLE_TIMEOUT_S = 10
+
 
 class CaribouPatternRunner:
     
@@ -24,10 +76,37 @@ class CaribouPatternRunner:
         # 2 - Write to file and return file name.
         
         self.default_return_mode = 1
+
+        # Content hash (see PreparedPattern.digest()) of the pattern currently
+        # held in each APG's write buffer, indexed by APG name.
+        self._apg_loaded = {}
+
+        # Default overlap for stream_pattern(): the number of samples each chunk
+        # replays from the end of the previous one and drops from its readback.
+        # Set this to the loopback latency of the DUT (in APG cycles) so that the
+        # idle samples at the start of each chunk's readback are trimmed.
+        self.stream_overlap = 0
+
+        # Write buffer depth (param_NUM_SAMP) of each APG, indexed by APG name.
+        self._apg_num_samp = {}
+
+        # APGs whose last run was not read back (return_mode 0). Their read channel
+        # may still hold samples, so the next run which reads back samples first
+        # clears the APG (which also empties its write buffer).
+        self._apg_unread = set()
     
     def run_pattern(self, glue_wave, tsf=1, return_mode=None, read_only=False):
         """Runs a pattern from a Glue Wave on a Spacely-Caribou APG.
            Returns the name of the sampled Glue Wave, or -1 on error.
+
+           The pattern is played and sampled for glue_wave.len * tsf clock cycles,
+           so the sampled Glue Wave is tsf times as long as glue_wave.
+
+           If that is more than the APG's memory (param_NUM_SAMP), the pattern is
+           streamed in chunks by stream_pattern() instead, with a warning. Each chunk
+           is a separate run, so unless stream_overlap is set to the DUT's loopback
+           latency, the first samples read back for each chunk are the response to
+           the idle APG rather than to the pattern.
            """
 
         
@@ -48,53 +127,280 @@ class CaribouPatternRunner:
             self._log.error(f"CaribouPatternRunner error: Attempted to write a GlueWave to APG {apg_name}, but GlueWave is configured to use the APG's '{glue_wave.hardware[2]}' interface (should be 'write')")
             return -1
 
-        ## (0) Wait for idle, then clear the write buffer.
-        self.apg_wait_for_idle(apg_name)
-        self.car.set_memory(f"{apg_name}_clear",1)
+        ## (0) Wait for idle.
+        if self.apg_wait_for_idle(apg_name) == -1:
+            return -1
+
+        if return_mode is None:
+            return_mode = self.default_return_mode
+
+        #Number of samples played (and read back), after time scaling.
+        N = glue_wave.len * tsf
+
+        ## (1) CHECK WHETHER THE APG ALREADY HOLDS THIS PATTERN
+        #If the last pattern uploaded to this APG had the same content, and its
+        #write buffer still holds that many samples, we can replay it as-is.
+        pattern_loaded = False
+        if not read_only:
+            pattern = PreparedPattern(glue_wave, tsf)
+
+            #Patterns that don't fit in the APG's memory are run in chunks.
+            if pattern.len > self.apg_num_samp(apg_name):
+                self._log.warning(f"Pattern for {apg_name} ({pattern.len} samples) does not fit in its memory ({self.apg_num_samp(apg_name)} samples), streaming it in chunks with stream_overlap={self.stream_overlap}.")
+                return self.stream_pattern(pattern, return_mode=return_mode)
+            
+            digest = pattern.digest(apg_name)
+            if self._apg_loaded.get(apg_name) == digest and not (return_mode > 0 and apg_name in self._apg_unread):
+                pattern_loaded = (self.car.get_memory(f"{apg_name}_write_buffer_len") == pattern.len)
 
-        ## (1) SET NUMBER OF SAMPLES
-        N = glue_wave.len
+        ## (2) CLEAR THE WRITE BUFFER AND SET NUMBER OF SAMPLES
+        if not pattern_loaded:
+            self.car.set_memory(f"{apg_name}_clear",1)
+            self._apg_loaded.pop(apg_name, None)
+            self._apg_unread.discard(apg_name)
 
         self.car.set_memory(f"{apg_name}_n_samples", N)
 
-        ## (2) WRITE PATTERN TO APG
+        ## (3) WRITE PATTERN TO APG
         #read_only argument allows us to skip writes.
-        if not read_only:
-            for n in range(N):
-                #Implement time scaling.
-                for _ in range(tsf):
-                    self.car.set_memory(f"{apg_name}_write_channel",glue_wave.vector[n])
+        if pattern_loaded:
+            self._log.debug(f"{apg_name} already holds this pattern, skipping upload.")
+        elif not read_only:
+            self.car.set_memory_block(f"{apg_name}_write_channel", pattern.vector)
+            self._apg_loaded[apg_name] = digest
 
 
-        ## (3) RUN AND WAIT FOR IDLE
+        ## (4) RUN AND WAIT FOR IDLE
         self.car.set_memory(f"{apg_name}_run", 1)
 
-        time.sleep(0.01)
-        self.apg_wait_for_idle(apg_name)
+        if self.apg_wait_for_idle(apg_name, N) == -1:
+            return -1
+
+        ## (5) READ BACK SAMPLES
+        #With return_mode 0 the APG is not cleared, so the pattern can be replayed without
+        #uploading it again. Unread samples are dealt with by the next run that reads back.
+        if return_mode > 0:
+            samples = self.apg_read_samples(apg_name, N)
+        else:
+            samples = None
+            self._apg_unread.add(apg_name)
+
+        return self._return_samples(apg_name, samples, return_mode)
+
+
+    def run_patterns(self, glue_waves, tsf=1, return_mode=None):
+        """Runs several Glue Waves at once, each on its own Spacely-Caribou APG.
+           Returns a list with one result per Glue Wave (as for run_pattern()), or -1 on error.
+
+           Uploads to all APGs are sent as one batch, then all the APGs' run registers
+           are written in a second batch, so the patterns start within a few AXI
+           writes of each other. Readbacks are likewise batched together.
+           Every pattern must fit in its APG's memory. As for run_pattern(), each
+           pattern is played and sampled for its length times tsf.
+           """
 
         if return_mode is None:
             return_mode = self.default_return_mode
 
+        ## (-1) Parse Glue Waves and pick up APG names.
+        apg_names = []
+        patterns = []
+        for glue_wave in glue_waves:
+            if type(glue_wave) == str:
+                glue_wave = self.gc.read_glue(glue_wave)
+
+            if glue_wave == -1:
+                self._log.error("GlueWave was -1, cannot run patterns.")
+                return -1
+
+            apg_name = glue_wave.hardware[1]
+
+            if glue_wave.hardware[2] != "write":
+                self._log.error(f"CaribouPatternRunner error: Attempted to write a GlueWave to APG {apg_name}, but GlueWave is configured to use the APG's '{glue_wave.hardware[2]}' interface (should be 'write')")
+                return -1
+
+            if apg_name in apg_names:
+                self._log.error(f"CaribouPatternRunner error: More than one GlueWave targets APG {apg_name}")
+                return -1
+
+            pattern = PreparedPattern(glue_wave, tsf)
+
+            if pattern.len > self.apg_num_samp(apg_name):
+                self._log.error(f"CaribouPatternRunner error: Pattern for {apg_name} ({pattern.len} samples) does not fit in its memory, use run_pattern() to stream it.")
+                return -1
+
+            apg_names.append(apg_name)
+            patterns.append(pattern)
+
+        ## (0) Wait for idle.
+        for apg_name in apg_names:
+            if self.apg_wait_for_idle(apg_name) == -1:
+                return -1
+
+        ## (1) CHECK WHICH APGS ALREADY HOLD THEIR PATTERN
+        digests = [pattern.digest(apg_name) for apg_name, pattern in zip(apg_names, patterns)]
+
+        with self.car.batch():
+            buffer_lens = [self.car.get_memory(f"{apg_name}_write_buffer_len")
+                           if self._apg_loaded.get(apg_name) == digest and not (return_mode > 0 and apg_name in self._apg_unread) else None
+                           for apg_name, digest in zip(apg_names, digests)]
+
+        pattern_loaded = [buffer_len is not None and buffer_len.result() == pattern.len
+                          for buffer_len, pattern in zip(buffer_lens, patterns)]
+
+        ## (2) CLEAR, SET NUMBER OF SAMPLES AND UPLOAD, FOR ALL APGS
+        with self.car.batch():
+            for apg_name, pattern, digest, loaded in zip(apg_names, patterns, digests, pattern_loaded):
+                if loaded:
+                    self._log.debug(f"{apg_name} already holds this pattern, skipping upload.")
+                else:
+                    self.car.set_memory(f"{apg_name}_clear",1)
+                    self._apg_loaded.pop(apg_name, None)
+                    self._apg_unread.discard(apg_name)
+
+                self.car.set_memory(f"{apg_name}_n_samples", pattern.len)
+
+                if not loaded:
+                    self.car.set_memory_block(f"{apg_name}_write_channel", pattern.vector)
+                    self._apg_loaded[apg_name] = digest
+
+        ## (3) RUN ALL APGS AND WAIT FOR IDLE
+        with self.car.batch():
+            for apg_name in apg_names:
+                self.car.set_memory(f"{apg_name}_run", 1)
+
+        for apg_name, pattern in zip(apg_names, patterns):
+            if self.apg_wait_for_idle(apg_name, pattern.len) == -1:
+                return -1
+
         ## (4) READ BACK SAMPLES
-        if return_mode > 0:
-            samples = []
+        #As in run_pattern(), return_mode 0 leaves the patterns loaded for replay.
+        if return_mode == 0:
+            self._apg_unread.update(apg_names)
+            return [None for _ in apg_names]
+
+        with self.car.batch():
+            readbacks = [self.car.get_memory_block(f"{apg_name}_read_channel", pattern.len)
+                         for apg_name, pattern in zip(apg_names, patterns)]
+
+        return [self._return_samples(apg_name, np.asarray(readback.result(), dtype=np.uint32), return_mode)
+                for apg_name, readback in zip(apg_names, readbacks)]
+
+    def stream_pattern(self, glue_wave, tsf=1, return_mode=None, overlap=None):
+        """Runs a pattern which is longer than the APG's memory (param_NUM_SAMP) on a
+           Spacely-Caribou APG, by splitting it into chunks of param_NUM_SAMP samples.
+           Returns the same as run_pattern(). run_pattern() calls this automatically
+           for long patterns.
+
+           Each time a chunk finishes, its readback and the clear, upload and run of
+           the next chunk are sent together as one batch, so the gap between chunks
+           is one round-trip plus the upload time. The APG has a single write buffer,
+           so chunk k+1 cannot be uploaded while chunk k is running; between chunks
+           the ASIC inputs sit at the APG's write defaults.
+
+           Because of that gap, the first samples read back for each chunk are the
+           response to the idle APG. With overlap > 0 (default: stream_overlap), every
+           chunk after the first also replays the last overlap samples of the
+           previous chunk, and those are dropped from its readback. With overlap set
+           to the DUT's loopback latency, the result matches a single run.
+           """
+
+        if return_mode is None:
+            return_mode = self.default_return_mode
 
-            for n in range(N):
-                samples.append(self.car.get_memory(f"{apg_name}_read_channel"))
+        if isinstance(glue_wave, PreparedPattern):
+            pattern = glue_wave
+        else:
+            pattern = PreparedPattern(glue_wave, tsf)
+        
+        if overlap is None:
+            overlap = self.stream_overlap
 
+        apg_name = pattern.hardware[1]
+        chunk_len = self.apg_num_samp(apg_name)
+        N = pattern.len
 
-            APG_CLOCK_FREQUENCY = 10e6
-            strobe_ps = 1/APG_CLOCK_FREQUENCY * 1e12
-            
-            read_glue = GlueWave(samples,strobe_ps,f"Caribou/{apg_name}/read")
+        if chunk_len <= 0:
+            self._log.error(f"Cannot stream to {apg_name}: invalid param_NUM_SAMP ({chunk_len})")
+            return -1
+
+        if not 0 <= overlap < chunk_len:
+            self._log.error(f"Cannot stream to {apg_name}: overlap ({overlap}) must be at least 0 and less than param_NUM_SAMP ({chunk_len})")
+            return -1
+
+        #Each chunk is (play_start, start, end): it plays samples play_start-end,
+        #and samples start-end of its readback are kept.
+        chunks = []
+        start = 0
+        while start < N:
+            play_start = max(0, start - overlap)
+            end = min(play_start + chunk_len, N)
+            chunks.append((play_start, start, end))
+            start = end
+
+        if self.apg_wait_for_idle(apg_name) == -1:
+            return -1
 
+        #The write buffer will only ever hold part of this pattern, and every
+        #chunk starts with a clear.
+        self._apg_loaded.pop(apg_name, None)
+        self._apg_unread.discard(apg_name)
+        
+        if return_mode > 0:
+            samples = np.empty(N, dtype=np.uint32)
         else:
-             self.car.set_memory(f"{apg_name}_clear",1)
+            samples = None
+
+        self._log.debug(f"Streaming {N} samples to {apg_name} in {len(chunks)} chunks of up to {chunk_len}, overlapping by {overlap}")
+
+        # prev = (play_start, start, end) of the chunk which is currently running.
+        prev = None
+        for chunk in chunks + [None]:
+            with self.car.batch():
+                ## READ BACK THE PREVIOUS CHUNK
+                if prev is not None and samples is not None:
+                    readback = self.car.get_memory_block(f"{apg_name}_read_channel", prev[2] - prev[0])
+
+                ## UPLOAD AND RUN THIS CHUNK
+                if chunk is not None:
+                    play_start, start, end = chunk
+                    self.car.set_memory(f"{apg_name}_clear",1)
+                    self.car.set_memory(f"{apg_name}_n_samples", end - play_start)
+                    self.car.set_memory_block(f"{apg_name}_write_channel", pattern.vector[play_start:end])
+                    buffer_len = self.car.get_memory(f"{apg_name}_write_buffer_len")
+                    self.car.set_memory(f"{apg_name}_run", 1)
+
+            if prev is not None and samples is not None:
+                samples[prev[1]:prev[2]] = np.asarray(readback.result(), dtype=np.uint32)[prev[1] - prev[0]:]
+
+            if chunk is None:
+                break
+
+            if buffer_len.result() != end - play_start:
+                self._log.error(f"Streaming to {apg_name} failed: uploaded samples {play_start}-{end} but write buffer holds {buffer_len.result()}")
+                return -1
+
+            if self.apg_wait_for_idle(apg_name, end - play_start) == -1:
+                return -1
+
+            prev = chunk
+
+        if samples is None:
+            self.car.set_memory(f"{apg_name}_clear",1)
+
+        return self._return_samples(apg_name, samples, return_mode)
 
+    def _return_samples(self, apg_name, samples, return_mode):
+        """Package samples read back from the named APG according to return_mode (see __init__)."""
         if return_mode == 0:
             return None
+
+        #The GlueWave wraps the NumPy array of samples directly, so even for
+        #return_mode 2 the samples never pass through a Python list.
+        strobe_ps = 1/APG_CLOCK_FREQUENCY * 1e12
+        read_glue = GlueWave(samples,strobe_ps,f"Caribou/{apg_name}/read")
             
-        elif return_mode == 1:
+        if return_mode == 1:
             return read_glue
             
         elif return_mode == 2:
@@ -102,7 +408,27 @@ class CaribouPatternRunner:
             self.gc.write_glue(read_glue,read_glue_file)
 
             return read_glue_file
+
+    def apg_num_samp(self, apg_name):
+        """Returns the depth of the named APG's write buffer (its param_NUM_SAMP)."""
+        if apg_name not in self._apg_num_samp:
+            self._apg_num_samp[apg_name] = self.car.get_memory(f"{apg_name}_param_NUM_SAMP")
+        return self._apg_num_samp[apg_name]
         
+    def apg_read_samples(self, apg_name, n_samples):
+        """Reads back n_samples from the named APG's read channel with a single bulk read.
+           Returns a uint32 NumPy array which shares memory with the received data."""
+        samples = self.car.get_memory_block(f"{apg_name}_read_channel", n_samples)
+        return np.asarray(samples, dtype=np.uint32)
+
+    def invalidate_pattern_cache(self, apg_name=None):
+        """Forget which pattern is loaded in the named APG (or in all APGs), so that
+           the next run_pattern() uploads it again. Call this after writing an APG's
+           write_channel or clear register outside of run_pattern()."""
+        if apg_name is None:
+            self._apg_loaded = {}
+        else:
+            self._apg_loaded.pop(apg_name, None)
         
     def update_io_defaults(self, apg_name):
         """Updates the field apg_write_defaults for the named APG to match self.gc.IO_Default"""
@@ -133,14 +459,40 @@ class CaribouPatternRunner:
 
         self.update_io_defaults(this_io_apg)
         
-    def apg_wait_for_idle(self, apg_name):
+    def apg_wait_for_idle(self, apg_name, n_samples=0, timeout_s=APG_IDLE_TIMEOUT_S):
+        """Waits for the named APG to become idle.
+           Returns the time waited in seconds, or -1 on timeout.
+
+           n_samples is the length of the pattern that was just started. The APG is
+           expected to be busy for n_samples clock cycles, so the first poll happens
+           after that time. After that, the poll interval starts at APG_POLL_MIN_S and
+           doubles up to APG_POLL_MAX_S. A short pattern therefore costs about one
+           round-trip.
+           """
+        start_time = time.perf_counter()
+
+        expected_s = n_samples / APG_CLOCK_FREQUENCY
+
+        # Sleeping for less than a round-trip gains nothing.
+        if expected_s > APG_POLL_MIN_S:
+            time.sleep(expected_s)
+
+        poll_s = APG_POLL_MIN_S
+        
         while True:
             status = self.car.get_memory(f"{apg_name}_status")
+            wait_s = time.perf_counter() - start_time
 
             if status == 0:
-                break
+                self._log.debug(f"{apg_name} idle after {wait_s*1e3:.2f} ms (expected {expected_s*1e3:.2f} ms)")
+                return wait_s
+
+            if wait_s > expected_s + timeout_s:
+                self._log.error(f"Timed out after {wait_s:.2f} s waiting for {apg_name} to become idle (status={status})")
+                return -1
 
-            time.sleep(0.1)
+            time.sleep(poll_s)
+            poll_s = min(2*poll_s, APG_POLL_MAX_S)
 
 #####################################################################
 ##                NI FPGA PATTERN RUNNER                           ##
@@ -191,6 +543,17 @@ GLUEFPGA_BITFILES = {"NI7976_NI6583_40MHz":GlueBitfile("NI7976","NI6583",3,40e6,
                      "NI7962_NI6581_40MHz":GlueBitfile("NI7972","NI6581",3,40e6,GLUEFPGA_DEFAULT_CFG,
                                                                SPACELY_BITFILE_FOLDER+"\\GlueDirectBitfile_NI7962_NI6581_40M_PROTO_12_6_2023.lvbitx")}
 
+# When one pattern run uses several FPGAs, Run_Pattern is asserted on them one after
+# another. A start skew above this is logged as a warning.
+NI_START_SKEW_WARN_NS = 100e3
+
+# NIPatternRunner.stream_pattern() moves samples to and from the host FIFOs in chunks of
+# this many samples, with host FIFOs NI_STREAM_FIFO_CHUNKS chunks deep. Each chunk transfer
+# may wait up to NI_STREAM_TIMEOUT_MS for data or space.
+NI_STREAM_CHUNK_LEN = 1 << 16
+NI_STREAM_FIFO_CHUNKS = 4
+NI_STREAM_TIMEOUT_MS = 5000
+
 # This dictionary lists the valid FIFOs for each NI RIO I/O card to enable lint checking.
 NI_IO_CARD_VALID_FIFOS = {"NI6583" : ["lvds", "se_io"],
                           "NI6581" : ["ddca_P0", "ddca_P1", "ddca_P2", "ddcb_P0", "ddcb_P1", "ddcb_P2"]}
@@ -266,7 +629,17 @@ class NIPatternRunner:
         #    time.sleep(1)
         #    self._interface[hw].interact("w","Set_Voltage_Family",False)
         
-        self._return_data = []
+        #Persistent pool of FIFO reader (and stream writer) threads, with its threads
+        #started up front so none are created inside the timing-critical start window.
+        self._start_reader_pool()
+
+        #Upper bound on the start skew between FPGAs in the last run_pattern(), in ns.
+        self.start_skew_ns = 0
+
+        #Host buffer depth configured for each FIFO, indexed by (fpga_name, fifo_name),
+        #and the Buffer_Pass_Size last written to each FPGA, indexed by fpga_name.
+        self._fifo_depth = {}
+        self._pass_size = {}
         
         if self._update_io_dir() == -1:
             return
@@ -436,10 +809,10 @@ class NIPatternRunner:
 
 
     # setup_pattern() - Performs the following tasks to prepare for running a pattern:
-    #   -- Configures the host buffer size to be sufficient
-    #   -- Sets Buffer_Pass_Size on the FPGA
+    #   -- Configures the host buffer size to be sufficient (only if the pattern grew)
+    #   -- Sets Buffer_Pass_Size on the FPGA (only if it changed)
     #   -- Loads the pattern into host memory
-    #   -- sets up (but doesn't run) a reader thread that will dump into a slot in self._return_data
+    #   -- returns (but doesn't submit) a reader job which returns the FIFO's data when run in the reader pool
     def setup_pattern(self,pattern):
 
         self._log.debug(f"Setting up pattern for hardware resource: {pattern.hardware_str}")
@@ -447,64 +820,79 @@ class NIPatternRunner:
         #Get the fpga object which we will be sending this pattern to. 
         fpga = self._fpga_dict[pattern.fpga_name]
 
-        #Extract some important parameters for this specific bitfile.
+        #Extract the readback offset for this specific bitfile.
         FPGA_READBACK_OFFSET = GLUEFPGA_BITFILES[fpga._bitfile_name].FPGA_READBACK_OFFSET
-        FPGA_CLOCK_HZ = GLUEFPGA_BITFILES[fpga._bitfile_name].FPGA_CLOCK_HZ
 
         #Identify the correct fifos and debugger based on the hardware specification of pattern.
         in_fifo_name = pattern.fifo_name+"_fifo_from_pc"
-        in_fifo = fpga.get_fifo(in_fifo_name)
-        out_fifo_name = pattern.fifo_name+"_fifo_to_pc"
-        out_fifo = fpga.get_fifo(out_fifo_name)
         dbg = self._interface[pattern.fpga_name]
         
-        #Ensure that there is enough memory on the host side for the pattern we want to run.
-        
-        try:
-            in_fifo.ref.buffer_size
-            READ_BUFFER_SIZE_SUPPORTED = True
-        except Exception as e:
-            if "FeatureNotSupported" in e.__str__():
-                self._log.warning("Unable to get buffer sizes due to FeatureNotSupported")
-                READ_BUFFER_SIZE_SUPPORTED = False
-            else:
-                raise(e)
-        
-        
-        if not READ_BUFFER_SIZE_SUPPORTED or (in_fifo.ref.buffer_size < pattern.len+FPGA_READBACK_OFFSET):
-            in_fifo.ref.configure(pattern.len+FPGA_READBACK_OFFSET)
+        #Ensure that there is enough memory on the host side for the pattern we want to run,
+        #and tell the FPGA how long it is.
+        self._configure_fifos(pattern, pattern.len+FPGA_READBACK_OFFSET, pattern.len+FPGA_READBACK_OFFSET)
 
-        if not READ_BUFFER_SIZE_SUPPORTED or (out_fifo.ref.buffer_size < pattern.len+FPGA_READBACK_OFFSET):
-            out_fifo.ref.configure(pattern.len+FPGA_READBACK_OFFSET)
-        
+        #Load the pattern into FIFO memory.
+        dbg.interact("w",in_fifo_name,pattern.vector)
+
+        # Create a job to read back the io fifo in parallel.
+        return functools.partial(self.thread_read, pattern.len+FPGA_READBACK_OFFSET, pattern)
+
+    # _configure_fifos() - Makes sure the host buffers of both of pattern's FIFOs hold at least
+    #  depth samples, and sets Buffer_Pass_Size for a pattern of read_len samples (including
+    #  the readback offset). The configured depth of each FIFO is remembered, so FIFOs are
+    #  only reconfigured (and we only wait for that to sink in) when more depth is needed.
+    def _configure_fifos(self, pattern, depth, read_len):
+        fpga = self._fpga_dict[pattern.fpga_name]
+        dbg = self._interface[pattern.fpga_name]
+        reconfigured = False
+
+        for fifo_name in (pattern.fifo_name+"_fifo_from_pc", pattern.fifo_name+"_fifo_to_pc"):
+            fifo = fpga.get_fifo(fifo_name)
+            key = (pattern.fpga_name, fifo_name)
+            configured_depth = self._fifo_depth.get(key)
+
+            if configured_depth is None:
+                try:
+                    configured_depth = fifo.ref.buffer_size
+                except Exception as e:
+                    if "FeatureNotSupported" in e.__str__():
+                        self._log.warning("Unable to get buffer sizes due to FeatureNotSupported")
+                    else:
+                        raise(e)
+
+            if configured_depth is None or configured_depth < depth:
+                fifo.ref.configure(depth)
+                configured_depth = depth
+                reconfigured = True
+
+            self._fifo_depth[key] = configured_depth
             
-        #Update Pattern Size in the FPGA
+        #Update Pattern Size in the FPGA, if it changed.
         #11/9/2023 NOTE: This "-1" is necessary to solve the Glue wave frame misalignment issue. 
         #Basically without it, frames that are read back will be offset by 1 bit / iteration from what you put in.
-        dbg.interact("w","Buffer_Pass_Size",pattern.len+FPGA_READBACK_OFFSET-1)
-
-        # (Allow host memory settings to sink in.)
-        time.sleep(0.2)
+        pass_size = read_len-1
+        if self._pass_size.get(pattern.fpga_name) != pass_size:
+            dbg.interact("w","Buffer_Pass_Size",pass_size)
+            self._pass_size[pattern.fpga_name] = pass_size
 
-        #Check Actual allocated buffer size
-        if READ_BUFFER_SIZE_SUPPORTED:
-            self._log.debug("out buffer size: "+str(out_fifo.ref.buffer_size))
-            self._log.debug("in buffer size: "+str(in_fifo.ref.buffer_size))
-
-        #Load the pattern into FIFO memory.
-        dbg.interact("w",in_fifo_name,pattern.vector)
+        if reconfigured:
+            # (Allow host memory settings to sink in.)
+            time.sleep(0.2)
 
-        # Create a thread to read back the io fifo in parallel.
-        return_data_idx = len(self._return_data)
-        self._return_data.append([])
-        reader = Thread(target=self.thread_read, args=(pattern.len+FPGA_READBACK_OFFSET,pattern,return_data_idx))
+            self._log.debug(f"Configured FIFOs for {pattern.hardware_str} to {depth} samples")
 
-        return reader
+    # invalidate_fifo_config() - Forget the remembered FIFO depths and Buffer_Pass_Size,
+    #  so that the next setup_pattern() configures them again (e.g. after an FPGA was reset).
+    def invalidate_fifo_config(self):
+        self._fifo_depth = {}
+        self._pass_size = {}
 
     # run_pattern() - Function for running a Glue Wave and getting the results.
     # PARAMETERS:
     #           pattern - A list of GlueWave() objects or .glue files that can be read to GlueWave() objects
     #           outfile - Optional .glue filename to write the result to.
+    # Patterns may target several FPGAs; they are all started together, and an upper
+    # bound on the start skew between them is kept in self.start_skew_ns.
     def run_pattern(self,patterns,time_scale_factor=1,outfile_tag=None):
 
         ## INPUT PROCESSING AND LINT CHECKING
@@ -520,6 +908,154 @@ class NIPatternRunner:
                 self._log.error("run_pattern(): Could not parse the value specified for outfile_tag. No outfile will be printed.")
                 outfile_tag = None
 
+        patterns = self._parse_patterns(patterns)
+        if patterns == -1:
+            return -1
+
+        ## PATTERN PREPARATION
+
+        #Convert each pattern to a time-scaled NumPy buffer. (The GlueWaves themselves are not modified.)
+        patterns = [PreparedPattern(p, time_scale_factor, np.uint64) for p in patterns]
+
+        ## SETUP 
+                
+        #Set up buffers and reader jobs, indexed by hardware_str.
+        readers = {}
+        for pattern in patterns:
+            readers[pattern.hardware_str] = self.setup_pattern(pattern)
+
+        #Every FPGA which has a pattern to run, in a fixed order.
+        fpga_names = list(dict.fromkeys(pattern.fpga_name for pattern in patterns))
+
+        ## Critical Timing: Must be < timeout ##
+        futures = {hw: self._reader_pool.submit(reader) for hw, reader in readers.items()}
+        self._start_fpgas(fpga_names)
+        ## End Critical Timing ##
+
+        try:
+            return_data = {hw: future.result() for hw, future in futures.items()}
+        finally:
+            for fpga_name in fpga_names:
+                self._interface[fpga_name].interact("w","Run_Pattern",False)
+
+
+        output_filenames = []
+
+        #Process the data returned by each reader.
+        for pattern in patterns:
+            #Extract some important parameters for the bitfile this pattern ran on.
+            bitfile = GLUEFPGA_BITFILES[self._fpga_dict[pattern.fpga_name]._bitfile_name]
+            FPGA_READBACK_OFFSET = bitfile.FPGA_READBACK_OFFSET
+            FPGA_CLOCK_HZ = bitfile.FPGA_CLOCK_HZ
+            
+            data = return_data[pattern.hardware_str][FPGA_READBACK_OFFSET:pattern.len+FPGA_READBACK_OFFSET]
+
+            out_pattern = GlueWave(data,1e12/FPGA_CLOCK_HZ,pattern.hardware,{"GLUE_TIMESTEPS":str(len(data))})
+
+            #Write a glue output file.
+            if outfile_tag is not None:
+                outfile_name = outfile_tag+"_"+pattern.hardware_str.replace("/","_")+".glue"
+                self.gc.write_glue(out_pattern,outfile_name)
+                output_filenames.append(outfile_name)
+        
+        return output_filenames
+
+    # stream_pattern() - Like run_pattern(), for patterns too long to hold in host FIFO memory.
+    #  While the patterns play, a writer thread per pattern feeds its _fifo_from_pc and a reader
+    #  thread drains its _fifo_to_pc, chunk_len samples at a time. Host FIFOs are only
+    #  NI_STREAM_FIFO_CHUNKS chunks deep however long the pattern is, and there is no limit
+    #  on run length as long as the host keeps up.
+    # PARAMETERS:
+    #           patterns - As for run_pattern()
+    #           out_dir  - Optional directory. If given, each pattern's read-back samples are written
+    #                      to a memory-mapped .npy file there (named after its hardware) instead of RAM.
+    # RETURNS: Dictionary of read-back sample arrays indexed by hardware_str, or -1 on error.
+    def stream_pattern(self,patterns,time_scale_factor=1,out_dir=None,chunk_len=NI_STREAM_CHUNK_LEN):
+
+        if type(time_scale_factor) is not int:
+            self._log.error("stream_pattern(): time_scale_factor must be an integer.")
+            return -1
+
+        patterns = self._parse_patterns(patterns)
+        if patterns == -1:
+            return -1
+
+        patterns = [PreparedPattern(p, time_scale_factor, np.uint64) for p in patterns]
+
+        ## SETUP
+        fifo_depth = NI_STREAM_FIFO_CHUNKS*chunk_len
+        results = {}
+        jobs = []
+        
+        for pattern in patterns:
+            fpga = self._fpga_dict[pattern.fpga_name]
+            FPGA_READBACK_OFFSET = GLUEFPGA_BITFILES[fpga._bitfile_name].FPGA_READBACK_OFFSET
+            
+            self._configure_fifos(pattern, fifo_depth, pattern.len+FPGA_READBACK_OFFSET)
+
+            if out_dir is None:
+                samples = np.empty(pattern.len, dtype=np.uint64)
+            else:
+                samples = np.lib.format.open_memmap(os.path.join(out_dir, pattern.hardware_str.replace("/","_")+".npy"),
+                                                    mode="w+", dtype=np.uint64, shape=(pattern.len,))
+            results[pattern.hardware_str] = samples
+
+            in_fifo = fpga.get_fifo(pattern.fifo_name+"_fifo_from_pc")
+            out_fifo = fpga.get_fifo(pattern.fifo_name+"_fifo_to_pc")
+
+            #Preload as much of the pattern as the host FIFO holds; the writer thread sends the rest.
+            preload = min(pattern.len, fifo_depth)
+            in_fifo.ref.write(pattern.vector[:preload], NI_STREAM_TIMEOUT_MS)
+
+            jobs.append(functools.partial(self._stream_write, in_fifo, pattern.vector, preload, chunk_len))
+            jobs.append(functools.partial(self._stream_read, out_fifo, samples, FPGA_READBACK_OFFSET, chunk_len))
+
+        fpga_names = list(dict.fromkeys(pattern.fpga_name for pattern in patterns))
+
+        ## RUN
+        futures = [self._reader_pool.submit(job) for job in jobs]
+        self._start_fpgas(fpga_names)
+
+        errors = [future.exception() for future in futures]
+
+        for fpga_name in fpga_names:
+            self._interface[fpga_name].interact("w","Run_Pattern",False)
+
+        errors = [e for e in errors if e is not None]
+        if len(errors) > 0:
+            for e in errors:
+                self._log.error(f"stream_pattern(): FIFO transfer failed: {e}")
+            return -1
+
+        for samples in results.values():
+            if isinstance(samples, np.memmap):
+                samples.flush()
+
+        return results
+
+    # _stream_write() - Writes vector[start:] to a _fifo_from_pc in chunks (stream_pattern() writer job).
+    def _stream_write(self, in_fifo, vector, start, chunk_len):
+        for i in range(start, len(vector), chunk_len):
+            in_fifo.ref.write(vector[i:i+chunk_len], NI_STREAM_TIMEOUT_MS)
+
+    # _stream_read() - Reads len(samples)+offset values from a _fifo_to_pc in chunks, dropping the
+    #  first offset (readback zeros) and storing the rest in samples (stream_pattern() reader job).
+    def _stream_read(self, out_fifo, samples, offset, chunk_len):
+        total = len(samples)+offset
+        pos = 0
+        while pos < total:
+            n = min(chunk_len, total-pos)
+            data = np.asarray(out_fifo.ref.read(n, NI_STREAM_TIMEOUT_MS).data, dtype=samples.dtype)
+            
+            first = max(pos, offset)
+            samples[first-offset:pos+n-offset] = data[first-pos:]
+            pos = pos + n
+
+    # _parse_patterns() - Turns the patterns argument of run_pattern() into a list of GlueWave()
+    #  objects, reading .glue files as needed, and checks their hardware was initialized.
+    #  Returns -1 on error.
+    def _parse_patterns(self, patterns):
+
         #Make sure "patterns" is a list of GlueWaves, or string filenames.
         if type(patterns) is str or type(patterns) is GlueWave:
             patterns = [patterns]
@@ -529,7 +1065,7 @@ class NIPatternRunner:
             
         if type(patterns) is not list:
             self._log.error(f"run_pattern could not parse patterns={patterns}")
-            return
+            return -1
 
         #If patterns contains filenames, we use read_glue() to get the actual GlueWave() object.
         for i in range(len(patterns)):
@@ -537,75 +1073,45 @@ class NIPatternRunner:
                 patterns[i] = self.gc.read_glue(patterns[i])
                 self._log.debug(f"Pattern Len from File:{len(patterns[i].vector)}")
 
-            try:
-                fpga = self._fpga_dict[patterns[i].fpga_name]
-            except KeyError:
+            if patterns[i].fpga_name not in self._fpga_dict:
                 print("(ERR) This pattern was generated for hardware",patterns[i].fpga_name)
                 print("      But the only hardware that was initialized is:",[x for x in self._fpga_dict.keys()])
                 print("      If you are SURE this is the right pattern, edit the Glue file to add a valid HARDWARE.")
                 return -1
 
-        ## TIME SCALE FACTOR
-
-        #Built-in method to slow down the pattern by a factor of time_scale_factor
-        if time_scale_factor != 1:
-            for i in range(len(patterns)):
-                patterns[i].vector = [x for x in patterns[i].vector for _ in range(0,time_scale_factor)]
-                patterns[i].len = len(patterns[i].vector)
-
-        ## SETUP 
-                
-        #Set up buffers and reader threads.
-        reader_threads = []
-        for pattern in patterns:
-            reader_threads.append(self.setup_pattern(pattern))
-
-        if len(self._interface.values()) > 1:
-            print("ERROR: NOT YET IMPLEMENTED! If we have multiple distinct pieces of hardware, how to ensure they start simultaneously?")
-            exit()
-        else:
-            dbg = list(self._interface.values())[0]
-            #Get the fpga object which we will be sending this pattern to. 
-            fpga = list(self._fpga_dict.values())[0]
-
-            #Extract some important parameters for this specific bitfile.
-            FPGA_READBACK_OFFSET = GLUEFPGA_BITFILES[fpga._bitfile_name].FPGA_READBACK_OFFSET
-            FPGA_CLOCK_HZ = GLUEFPGA_BITFILES[fpga._bitfile_name].FPGA_CLOCK_HZ
-
-        ## Critical Timing: Must be < timeout ##
-        for t in reader_threads:
-            t.start()
-        dbg.interact("w","Run_Pattern",True)
-        ## End Critical Timing ##
-
-        for t in reader_threads:
-            t.join()
-
-        dbg.interact("w","Run_Pattern",False)
-
+        #Results are indexed by hardware_str, so each FIFO can only run one pattern at a time.
+        hardware_strs = [pattern.hardware_str for pattern in patterns]
+        if len(set(hardware_strs)) != len(hardware_strs):
+            self._log.error(f"run_pattern: more than one pattern targets the same FIFO ({hardware_strs})")
+            return -1
 
-        output_filenames = []
+        return patterns
 
-        #Process the data returned by each thread.
-        for i in range(len(self._return_data)):
-            data = self._return_data[i][FPGA_READBACK_OFFSET:patterns[i].len+FPGA_READBACK_OFFSET]
 
-            out_pattern = GlueWave(data,1e12/FPGA_CLOCK_HZ,patterns[i].hardware,{"GLUE_TIMESTEPS":str(len(data))})
+    # _start_fpgas() - Asserts Run_Pattern on each named FPGA, back to back. An upper bound on
+    #  the start skew between them is kept in self.start_skew_ns.
+    def _start_fpgas(self, fpga_names):
+        dbgs = [self._interface[fpga_name] for fpga_name in fpga_names]
 
-            #Write a glue output file.
-            if outfile_tag is not None:
-                outfile_name = outfile_tag+"_"+patterns[i].hardware_str.replace("/","_")+".glue"
-                self.gc.write_glue(out_pattern,outfile_name)
-                output_filenames.append(outfile_name)
+        start_ns = []
+        for dbg in dbgs:
+            t_before = time.perf_counter_ns()
+            dbg.interact("w","Run_Pattern",True)
+            start_ns.append((t_before, time.perf_counter_ns()))
 
-        #Clear self._return_data so it can be used next time.
-        self._return_data = []
-        
-        return output_filenames
+        #Each FPGA started somewhere between the start and end of its write, so this
+        #is an upper bound on the start skew between FPGAs.
+        self.start_skew_ns = start_ns[-1][1] - start_ns[0][0]
+        if len(dbgs) > 1:
+            if self.start_skew_ns > NI_START_SKEW_WARN_NS:
+                self._log.warning(f"Start skew between {len(dbgs)} FPGAs was up to {self.start_skew_ns/1e3:.1f} us")
+            else:
+                self._log.debug(f"Start skew between {len(dbgs)} FPGAs was up to {self.start_skew_ns/1e3:.1f} us")
 
-    # thread_read() - Function for reading back a fifo_to_pc output asynchronously using a thread;
+    # thread_read() - Function for reading back a fifo_to_pc output asynchronously in the reader pool;
     #                 requires the length to read, and a copy of the input GlueWave() so it can extract hardware info.
-    def thread_read(self, read_len, in_pattern,return_data_idx):
+    #                 Returns the data read.
+    def thread_read(self, read_len, in_pattern):
         #y is a tuple, where y[0] is the returned glue waveform.
 
         dbg = self._interface[in_pattern.fpga_name]
@@ -613,7 +1119,18 @@ class NIPatternRunner:
     
         y = dbg.interact("r",out_fifo_name,read_len)
 
-        self._return_data[return_data_idx] = y[0]
+        return y[0]
+
+    # _start_reader_pool() - Creates the reader pool, with two threads (reader and stream writer)
+    #  per FIFO in the iospec, and waits for all of them to start.
+    def _start_reader_pool(self):
+        n_threads = 2*max(1, len(set(self.gc.IO_hardware.values())))
+        self._reader_pool = ThreadPoolExecutor(max_workers=n_threads, thread_name_prefix="NIPatternRunner")
+
+        #Each warm-up job blocks until all of them are running, which forces the pool to start every thread.
+        barrier = Barrier(n_threads)
+        for future in [self._reader_pool.submit(barrier.wait) for _ in range(n_threads)]:
+            future.result()
 
     ### OBSOLETE! Use sg.gc.dict2Glue()
     #def genpattern_from_waves_dict(self, waves_dict, time_scale_factor=1):
@@ -633,54 +1150,76 @@ class NIPatternRunner:
 
 # ASSUMPTION: The intended pattern is a uniformly increasing set of integers.
 # rp = Returned pattern
+#
+# The pattern is taken to start at the first 0,1,2,3 sequence. After that, a timeout
+# begins wherever the count breaks (rp[j] != rp[j-1]+1), at value rp[j-1]. It ends either
+# when the count resumes from where it stopped (rp[k] == rp[j-1]+1), or when the count
+# continues from somewhere else (rp[k] == rp[k-1]+1), which is a skip.
+#
+# Returns a dictionary of NumPy arrays with one entry per timeout:
+#   "position"          - index j at which the timeout began
+#   "value"             - last value before the timeout
+#   "duration"          - number of cycles until it ended
+#   "counts_since_last" - counts between the previous timeout's value and this one
+#   "skip"              - True if the count skipped instead of resuming
+#   "skip_to"           - for skips, the last out-of-order value before counting continued
+# plus "start" (index of the pattern start, or None if there is none) and "unterminated"
+# (position of a timeout still in progress at the end of rp, or None).
 def diagnose_fifo_timeout(rp):
-
-    pattern_started = False
-    in_timeout = False
-    timeout_count = 0
-    last_timeout = 0
-    this_timeout = 0
-
-    for i in range(len(rp)):
-        if i > 2 and rp[i] == 3 and rp[i-1] == 2 and rp[i-2] == 1 and rp[i-3] == 0:
-           pattern_started = True
-
-        if pattern_started:
-
-            if in_timeout:
-                #Timeout ends
-                if rp[i] == this_timeout + 1:
-                    print("(WARN) Timeout at value",this_timeout,"lasting",timeout_count,"cycles. (",(this_timeout-last_timeout),"counts since last timeout. )")
-                    in_timeout = False
-                    timeout_count = 0
-                    last_timeout = this_timeout
-
-                #It was a skip timeout.
-                elif rp[i] == rp[i-1] + 1:
-                    print("(WARN) Skip from",this_timeout,"to",rp[i-1])
-                    in_timeout = False
-                    timeout_count = 0
-                    last_timeout = this_timeout
-                #Timeout continues.
-                else:
-                    timeout_count = timeout_count + 1
-
-
+    rp = np.asarray(rp, dtype=np.int64)
+    report = {"start": None, "unterminated": None}
+    timeouts = {"position": [], "value": [], "duration": [], "counts_since_last": [], "skip": [], "skip_to": []}
+
+    #Find the pattern start.
+    if len(rp) >= 4:
+        starts = np.flatnonzero((rp[:-3] == 0) & (rp[1:-2] == 1) & (rp[2:-1] == 2) & (rp[3:] == 3))
+        if len(starts) > 0:
+            report["start"] = int(starts[0]) + 3
+
+    if report["start"] is not None:
+        #ok[i] is True where rp[i] continues the count from rp[i-1] (ok[0] is unused).
+        ok = np.empty(len(rp), dtype=bool)
+        ok[0] = True
+        ok[1:] = np.diff(rp) == 1
+        breaks = np.flatnonzero(~ok)
+        continues = np.flatnonzero(ok)
+
+        last_timeout = 0
+        i = report["start"]
+        while True:
+            #Next break after i begins a timeout.
+            b = np.searchsorted(breaks, i, side="right")
+            if b == len(breaks):
+                break
+            j = int(breaks[b])
+            v = int(rp[j-1])
+
+            #The timeout ends at the first continuing count, or earlier if the value resumes.
+            c = np.searchsorted(continues, j, side="right")
+            k_skip = int(continues[c]) if c < len(continues) else len(rp)
+            resumed = np.flatnonzero(rp[j+1:k_skip+1] == v+1)
+
+            if len(resumed) > 0:
+                k = j + 1 + int(resumed[0])
+                skip = False
+            elif k_skip < len(rp):
+                k = k_skip
+                skip = True
             else:
-                #Timeout begins
-                if rp[i] != rp[i-1] + 1:
-                    in_timeout = True
-                    timeout_count = 1
-                    this_timeout = rp[i-1]
+                report["unterminated"] = j
+                break
 
-                #Normal count continues.
-                else:
-                    continue
+            timeouts["position"].append(j)
+            timeouts["value"].append(v)
+            timeouts["duration"].append(k-j)
+            timeouts["counts_since_last"].append(v-last_timeout)
+            timeouts["skip"].append(skip)
+            timeouts["skip_to"].append(int(rp[k-1]) if skip else -1)
 
-    if not pattern_started:
-        print("(ERR) No incrementing pattern detected in this Glue wave :(")
+            last_timeout = v
+            i = k
 
-    if this_timeout == 0:
-        print("(INFO) No timeouts detected :D")
-                
-            
+    for key, values in timeouts.items():
+        report[key] = np.array(values, dtype=bool if key == "skip" else np.int64)
+
+    return report
@@ -0,0 +1,258 @@
+import pytest
+import sys
+import os
+import socket
+import threading
+import asyncio
+
+sys.path.append(os.path.abspath("."))
+sys.path.append(os.path.abspath("./src"))
+from PearyClient import *
+
+
+def echo(cmd, args):
+    """Default pearyd behaviour: a few special commands, everything else is echoed back."""
+    if cmd == "protocol_version":
+        return STATUS_OK, PROTOCOL_VERSION
+    if cmd == "fail":
+        return 1, b"failed on purpose"
+    if cmd == "big":
+        return STATUS_OK, b"x" * int(args[0])
+    if cmd == "hang":
+        # never answered
+        return None
+    return STATUS_OK, " ".join([cmd] + args).encode("utf-8")
+
+
+class FakePeary(threading.Thread):
+    """A minimal pearyd on one end of a socketpair.
+
+       Replies to each batch of requests that arrives together are sent in reverse order,
+       so the client has to match them by sequence number. With write_size set, replies
+       are sent a few bytes at a time so they arrive split across several reads.
+
+       handle(cmd, args) returns (status, payload), or None to leave the request unanswered."""
+
+    def __init__(self, sock, handle=echo, write_size=None):
+        super().__init__(daemon=True)
+        self.sock = sock
+        self.handle = handle
+        self.write_size = write_size
+        self.seqs = []
+
+    def run(self):
+        buf = bytearray()
+        while True:
+            data = self.sock.recv(65536)
+            if not data:
+                break
+            buf += data
+
+            replies = []
+            while len(buf) >= LENGTH.size:
+                length, = LENGTH.unpack_from(buf)
+                if len(buf) < LENGTH.size + length:
+                    break
+                seq, _ = HEADER.unpack_from(buf, LENGTH.size)
+                cmd, *args = bytes(buf[LENGTH.size + HEADER.size:LENGTH.size + length]).decode("utf-8").split(" ")
+                del buf[:LENGTH.size + length]
+
+                self.seqs.append(seq)
+                reply = self.handle(cmd, args)
+                if reply is None:
+                    continue
+                status, payload = reply
+                replies.append(LENGTH.pack(HEADER.size + len(payload)) + HEADER.pack(seq, status) + payload)
+
+            out = b"".join(reversed(replies))
+            step = self.write_size or len(out) or 1
+            for i in range(0, len(out), step):
+                self.sock.sendall(out[i:i + step])
+        self.sock.close()
+
+
+@pytest.fixture
+def connect(monkeypatch):
+    """Returns a function that connects a PearyClient to a new FakePeary."""
+    servers = []
+    clients = []
+
+    def _connect(**kwargs):
+        client_sock, server_sock = socket.socketpair()
+        server = FakePeary(server_sock, **kwargs)
+        server.start()
+        servers.append(server)
+        monkeypatch.setattr(socket, "create_connection", lambda address: client_sock)
+        client = PearyClient(host="localhost")
+        clients.append(client)
+        return client, server
+
+    yield _connect
+    for client in clients:
+        client._close()
+    for server in servers:
+        server.join(timeout=5)
+
+
+def test_request(connect):
+    client, server = connect()
+    assert client._request("hello", 1, 2) == b"hello 1 2"
+
+def test_request_failure(connect):
+    client, server = connect()
+    with pytest.raises(Failure) as e:
+        client._request("fail")
+    assert e.value.code == 1
+    # The connection is still usable.
+    assert client._request("hello") == b"hello"
+
+def test_pipelined(connect):
+    client, server = connect()
+    # More than one PIPELINE_WINDOW, so the window is refilled while replies come in.
+    requests = [("get", i) for i in range(3 * PIPELINE_WINDOW + 5)]
+    assert client._request_pipelined(requests) == [f"get {i}".encode() for i in range(len(requests))]
+
+def test_pipelined_seq_wraparound(connect):
+    client, server = connect()
+    client._sequence_number = 65530
+    requests = [("get", i) for i in range(10)]
+    assert client._request_pipelined(requests) == [f"get {i}".encode() for i in range(10)]
+    # protocol_version used 1; the sequence numbers skip 65535 and wrap to 0.
+    assert server.seqs[1:] == [65531, 65532, 65533, 65534, 0, 1, 2, 3, 4, 5]
+
+def test_pipelined_failure(connect):
+    client, server = connect()
+    requests = [("a",), ("fail",), ("b",), ("fail",)]
+    with pytest.raises(Failure):
+        client._request_pipelined(requests)
+    # Every reply was drained, so the next request gets its own reply.
+    assert client._request("hello") == b"hello"
+
+def test_pipelined_return_exceptions(connect):
+    client, server = connect()
+    results = client._request_pipelined([("a",), ("fail",), ("b",)], return_exceptions=True)
+    assert results[0] == b"a"
+    assert isinstance(results[1], Failure)
+    assert results[1].code == 1
+    assert results[1].reason == b"failed on purpose"
+    assert results[2] == b"b"
+
+def test_reply_split_across_reads(connect):
+    # Replies trickle in 3 bytes at a time, splitting length prefixes and headers.
+    client, server = connect(write_size=3)
+    assert client._request("hello", "world") == b"hello world"
+    requests = [("get", i) for i in range(50)]
+    assert client._request_pipelined(requests) == [f"get {i}".encode() for i in range(50)]
+
+def test_reply_larger_than_rx_buffer(connect):
+    client, server = connect()
+    size = 3 * RX_BUFFER_SIZE + 7
+    assert client._request("big", size) == b"x" * size
+    assert len(client._rx_buffer) >= size
+    # Back-to-back replies keep working, including ones that straddle the end of the buffer
+    # and have to be moved to its front.
+    requests = [("big", 1000 + i) for i in range(500)]
+    assert client._request_pipelined(requests) == [b"x" * (1000 + i) for i in range(500)]
+
+
+class DeviceHandler:
+    """pearyd with one SpacelyCaribouBasic device at index 0, whose memory registers behave
+       like FIFOs: block writes append words, block reads take them from the front."""
+
+    def __init__(self):
+        self.memory = {}
+
+    def __call__(self, cmd, args):
+        if cmd == "list_devices":
+            return STATUS_OK, b"0"
+        if cmd == "device.name":
+            return STATUS_OK, b"SpacelyCaribouBasicDevice"
+        if cmd == "device.get_register":
+            return STATUS_OK, b"42"
+        if cmd == "device.set_memory_block":
+            self.memory.setdefault(args[1], []).extend(unpack_words(bytes.fromhex(args[2])))
+            return STATUS_OK, b""
+        if cmd == "device.get_memory_block":
+            words = self.memory.setdefault(args[1], [])
+            n = int(args[2])
+            reply, words[:n] = words[:n], []
+            return STATUS_OK, pack_words(reply).hex().encode("utf-8")
+        return echo(cmd, args)
+
+
+@pytest.fixture
+def connect_async(monkeypatch):
+    """Returns a coroutine function that connects an AsyncPearyClient to a new FakePeary."""
+    servers = []
+    open_connection = asyncio.open_connection
+
+    async def _connect(**kwargs):
+        client_sock, server_sock = socket.socketpair()
+        server = FakePeary(server_sock, **kwargs)
+        server.start()
+        servers.append(server)
+        monkeypatch.setattr(asyncio, "open_connection", lambda host, port: open_connection(sock=client_sock))
+        return await AsyncPearyClient.connect(host="localhost"), server
+
+    yield _connect
+    for server in servers:
+        server.join(timeout=5)
+
+
+def test_async_interleaved(connect_async):
+    async def run():
+        client, server = await connect_async()
+        async with client:
+            # Replies to each batch come back in reverse order.
+            return await asyncio.gather(*(client._request("get", i) for i in range(3 * PIPELINE_WINDOW)))
+
+    assert asyncio.run(run()) == [f"get {i}".encode() for i in range(3 * PIPELINE_WINDOW)]
+
+def test_async_failure(connect_async):
+    async def run():
+        client, server = await connect_async()
+        async with client:
+            return await asyncio.gather(client._request("a"), client._request("fail"), client._request("b"),
+                                        return_exceptions=True)
+
+    a, fail, b = asyncio.run(run())
+    assert (a, b) == (b"a", b"b")
+    assert isinstance(fail, Failure)
+    assert fail.code == 1
+    assert fail.reason == b"failed on purpose"
+
+def test_async_close_in_flight(connect_async):
+    async def run():
+        client, server = await connect_async()
+        request = asyncio.ensure_future(client._request("hang"))
+        while not client._pending:
+            await asyncio.sleep(0.01)
+        await client.close()
+        # The request fails instead of waiting forever.
+        with pytest.raises(InvalidReply):
+            await asyncio.wait_for(request, 5)
+        assert client._reader_task.done()
+        # Later requests fail straight away.
+        with pytest.raises(InvalidReply):
+            await client._request("a")
+
+    asyncio.run(run())
+
+def test_async_device(connect_async):
+    async def run():
+        client, server = await connect_async(handle=DeviceHandler())
+        async with client:
+            device = await client.ensure_device("SpacelyCaribouBasic")
+            assert device.device_type == "SpacelyCaribouBasic"
+            assert device.index == 0
+            assert await device.get_register("reg1") == 42
+
+            # More than one block transfer in each direction.
+            words = list(range(BLOCK_TRANSFER_WORDS + 10))
+            await device.set_memory_block("apg_write_channel", words)
+            assert list(await device.get_memory_block("apg_write_channel", len(words))) == words
+
+            # Unknown methods are forwarded as-is.
+            assert await device.custom("x") == b"device.custom 0 x"
+
+    asyncio.run(run())
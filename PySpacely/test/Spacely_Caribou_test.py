@@ -18,7 +18,10 @@ def dbg_log():
 
 @pytest.fixture
 def car(dbg_log):
-    return Caribou("EMULATE",12345,"SpacelyCaribouBasic", dbg_log)
+    car = Caribou("EMULATE",12345,"SpacelyCaribouBasic", dbg_log)
+    yield car
+    # Release the Caribou lock even if the test kept a reference to car (e.g. in a traceback).
+    car.close()
 
 
 
@@ -47,3 +50,165 @@ def test_firmware_readback(car):
     readback_val = car.get_memory("reg1")
     assert readback_val == test_val
     
+
+def test_firmware_block_readback(car):
+    test_vals = [random.randint(1,100) for _ in range(10)]
+    car.set_axi_registers(TEST_FIRMWARE)
+    car.set_memory_block("reg2", test_vals)
+    # VirtualCaribou registers are plain storage, so the last word written is read back.
+    readback_vals = car.get_memory_block("reg2", 3)
+    assert list(readback_vals) == [test_vals[-1]]*3
+
+TEST_MEM_MAP = ["*BASE 0x400000000",
+                "reg1,0x0,0xffffffff,True,True",
+                "reg2,0x4,0x1,False,True",
+                "reg3,0x8,0xffffffff,True,False",
+                "param_REG,0xc,0xffffffff,True,False"]
+
+def test_shadow_registers(car):
+    car.set_axi_registers(TEST_FIRMWARE + ["param_REG"])
+    car.enable_shadow_registers(parse_mem_map(TEST_MEM_MAP))
+
+    # Rewriting an unchanged read/write register is skipped.
+    car.set_memory("reg1", 5)
+    car._client.vc.reg["reg1"] = 9
+    car.set_memory("reg1", 5)
+    assert car._client.vc.reg["reg1"] == 9
+    car.invalidate_shadow(SHADOW_RW)
+    car.set_memory("reg1", 5)
+    assert car._client.vc.reg["reg1"] == 5
+
+    # Static registers are only read from hardware once.
+    car._client.vc.reg["param_REG"] = 16
+    assert car.get_memory("param_REG") == 16
+    car._client.vc.reg["param_REG"] = 32
+    assert car.get_memory("param_REG") == 16
+
+    # Read-only status registers are never cached.
+    car._client.vc.reg["reg3"] = 1
+    assert car.get_memory("reg3") == 1
+    car._client.vc.reg["reg3"] = 2
+    assert car.get_memory("reg3") == 2
+
+def test_shadow_strobe_registers(car):
+    car.set_axi_registers(["apg_run", "apg_clear", "apg_control"])
+    car.enable_shadow_registers(parse_mem_map(["*BASE 0x400000000",
+                                               "apg_run,0x0,0x1,True,True",
+                                               "apg_clear,0x4,0x1,True,True",
+                                               "apg_control,0x8,0xff,True,True"]))
+    assert car._shadow_types["apg_run"] == SHADOW_VOLATILE
+    assert car._shadow_types["apg_clear"] == SHADOW_VOLATILE
+    assert car._shadow_types["apg_control"] == SHADOW_RW
+
+    # Strobes clear themselves, so writing 1 again must reach hardware.
+    for strobe in ["apg_run", "apg_clear"]:
+        car.set_memory(strobe, 1)
+        car._client.vc.reg[strobe] = 0
+        car.set_memory(strobe, 1)
+        assert car._client.vc.reg[strobe] == 1
+        car._client.vc.reg[strobe] = 0
+        assert car.get_memory(strobe) == 0
+
+def test_batch(car):
+    car.set_axi_registers(TEST_FIRMWARE)
+    with car.batch():
+        car.set_memory("reg1", 7)
+        readback = car.get_memory("reg1")
+        # Nothing is sent until the batch exits.
+        assert car._client.vc.reg["reg1"] == 0
+        assert not readback.done()
+    assert readback.result() == 7
+
+def test_batch_block(car):
+    car.set_axi_registers(TEST_FIRMWARE)
+    with car.batch():
+        car.set_memory_block("reg2", [1, 2, 3])
+        readback = car.get_memory_block("reg2", 2)
+        assert not readback.done()
+    assert list(readback.result()) == [3, 3]
+
+def fail_writes_to(car, monkeypatch, mem_name):
+    """Make VirtualCaribou reject every write to mem_name."""
+    vc = car._client.vc
+    set_memory = vc.device_set_memory
+    def failing_set_memory(args):
+        if args[0] == mem_name:
+            raise VirtualCaribouException(f"write to {mem_name} failed")
+        return set_memory(args)
+    monkeypatch.setattr(vc, "device_set_memory", failing_set_memory)
+
+def test_shadow_discarded_batch(car):
+    car.set_axi_registers(TEST_FIRMWARE)
+    car.enable_shadow_registers(parse_mem_map(TEST_MEM_MAP))
+
+    with pytest.raises(RuntimeError):
+        with car.batch():
+            car.set_memory("reg1", 5)
+            raise RuntimeError("abort")
+    assert "reg1" not in car.shadow
+
+    car.set_memory("reg1", 5)
+    assert car._client.vc.reg["reg1"] == 5
+    assert car.shadow["reg1"] == 5
+
+def test_shadow_failed_batch_write(car, monkeypatch):
+    car.set_axi_registers(TEST_FIRMWARE)
+    car.enable_shadow_registers(parse_mem_map(TEST_MEM_MAP))
+    fail_writes_to(car, monkeypatch, "reg1")
+
+    with pytest.raises(Failure):
+        with car.batch():
+            write = car.set_memory("reg1", 5)
+            car.set_memory("reg2", 1)
+    assert isinstance(write.exception(), Failure)
+    assert "reg1" not in car.shadow
+    assert car.shadow["reg2"] == 1
+
+    monkeypatch.undo()
+    car.set_memory("reg1", 5)
+    assert car._client.vc.reg["reg1"] == 5
+
+def test_shadow_failed_write(car, monkeypatch):
+    car.set_axi_registers(TEST_FIRMWARE)
+    car.enable_shadow_registers(parse_mem_map(TEST_MEM_MAP))
+    car.set_memory("reg1", 3)
+    fail_writes_to(car, monkeypatch, "reg1")
+
+    with pytest.raises(VirtualCaribouException):
+        car.set_memory("reg1", 5)
+    assert "reg1" not in car.shadow
+
+    monkeypatch.undo()
+    car.set_memory("reg1", 5)
+    assert car._client.vc.reg["reg1"] == 5
+
+def test_batch_block_failure(car, monkeypatch):
+    car.set_axi_registers(TEST_FIRMWARE)
+    vc = car._client.vc
+    get_memory_block = vc.device_get_memory_block
+    calls = []
+    def failing_get_memory_block(args):
+        calls.append(args)
+        if len(calls) == 1:
+            raise VirtualCaribouException("first chunk failed")
+        return get_memory_block(args)
+    monkeypatch.setattr(vc, "device_get_memory_block", failing_get_memory_block)
+
+    with pytest.raises(Failure):
+        with car.batch():
+            readback = car.get_memory_block("reg2", 40000)
+    # All chunks were sent, and the first failure is reported once, on the joined Future.
+    assert len(calls) == 3
+    assert isinstance(readback.exception(), Failure)
+
+def test_shadow_batch_write_only(car):
+    car.set_axi_registers(TEST_FIRMWARE)
+    car.enable_shadow_registers(parse_mem_map(TEST_MEM_MAP))
+
+    # A write-only register read back in the same batch sees the queued write.
+    with car.batch():
+        car.set_memory("reg2", 1)
+        readback = car.get_memory("reg2")
+        assert not readback.done()
+    assert readback.result() == 1
+    assert car.shadow["reg2"] == 1
@@ -152,3 +152,19 @@ def test_cadder_mode1(twin_mode_1):
 
 def test_cadder_mode2(twin_mode_2):
     run_routine_cocotb("ROUTINE_test_cadder_mode1_2")
+
+def test_apg_tsf_stream_mode1(twin_mode_1):
+    run_routine_cocotb("ROUTINE_test_apg_tsf_stream")
+
+def test_twin_get_memory_block(sg_log, monkeypatch):
+    # No simulator needed: the AXI reads are replaced by a counter.
+    twin = CaribouTwin(mem_map_file=os.path.join(PYTEST_ASIC_SRC, "hdl", "mem_map.txt"))
+    reads = iter(range(100, 200))
+    monkeypatch.setattr(twin, "get_memory", lambda mem_name: twin._batch_result(next(reads)))
+
+    samples = twin.get_memory_block("read_channel", 4)
+    # Same type as Caribou.get_memory_block() returns.
+    assert samples == array('I', [100, 101, 102, 103])
+    with twin.batch():
+        future = twin.get_memory_block("read_channel", 2)
+    assert future.result() == array('I', [104, 105])
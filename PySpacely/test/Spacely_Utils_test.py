@@ -0,0 +1,238 @@
+import pytest
+import sys
+import os
+
+import numpy as np
+from statistics import NormalDist
+
+sys.path.append(os.path.abspath("."))
+sys.path.append(os.path.abspath("./src"))
+import Spacely_Utils
+from Spacely_Utils import *
+
+import fnal_log_wizard as liblog
+
+# 495.0 mV to 504.9 mV in 0.1 mV steps, as used by find_DNL().
+SWEEP = [round(x*0.1,1) for x in range(4950,5050)]
+
+@pytest.fixture
+def dbg_log(monkeypatch):
+    log = liblog.PlainLogger(liblog.HandleOutputStrategy())
+    monkeypatch.setattr(sg, "log", log)
+    return log
+
+
+def step_response(Vtrip):
+    """A comparator that reads 0 up to and including Vtrip, and 1 above it."""
+    return lambda v: 0.0 if v <= Vtrip else 1.0
+
+def full_sweep_trip_point(measure, Vtest_sweep):
+    """The trip point a measurement at every voltage finds."""
+    Vtrip = 0
+    for i, v in enumerate(Vtest_sweep):
+        if measure(v) < 0.5 and (i+1 == len(Vtest_sweep) or measure(Vtest_sweep[i+1]) > 0.5):
+            Vtrip = v
+    return Vtrip
+
+
+def test_trip_point_middle(dbg_log):
+    Vtrip, samples = find_trip_point(step_response(500.3), SWEEP)
+    assert Vtrip == 500.3
+    # Bisection plus the local sweep, rather than all 100 points.
+    assert len(samples) < 20
+    assert all(samples[v] == step_response(500.3)(v) for v in samples)
+
+def test_trip_point_ramp(dbg_log):
+    # A response that climbs from 0 to 1 over 1 mV, as a noisy comparator would on average.
+    measure = lambda v: round(min(1.0, max(0.0, (v - 499.75))), 2)
+    Vtrip, samples = find_trip_point(measure, SWEEP)
+    assert Vtrip == full_sweep_trip_point(measure, SWEEP) == 500.2
+
+def test_trip_point_none_in_range(dbg_log):
+    # Never trips: like a full sweep, the last voltage is returned.
+    assert find_trip_point(lambda v: 0.0, SWEEP)[0] == SWEEP[-1]
+    # Always tripped: no trip point.
+    assert find_trip_point(lambda v: 1.0, SWEEP)[0] == 0
+
+def test_trip_point_edges(dbg_log):
+    assert find_trip_point(step_response(SWEEP[0]), SWEEP)[0] == SWEEP[0]
+    assert find_trip_point(step_response(SWEEP[-2]), SWEEP)[0] == SWEEP[-2]
+
+def test_trip_point_empty_sweep(dbg_log):
+    def measure(v):
+        raise AssertionError("nothing to measure")
+    assert find_trip_point(measure, []) == (None, {})
+
+
+def test_array_histogram():
+    assert array_histogram(np.array([512, 511, 512, 514, 512])) == {511: 1, 512: 3, 514: 1}
+    assert array_histogram([3]) == {3: 1}
+    assert array_histogram([-2, 0, -2]) == {-2: 2, 0: 1}
+    assert array_histogram([]) == {}
+
+def test_liststring_histogram():
+    # Strings from the HAL and arrays from command_ng_array() give the same histogram.
+    assert liststring_histogram("512\n511\n512\n") == array_histogram([512, 511, 512]) == {511: 1, 512: 2}
+
+def test_liststring_bad_values():
+    with pytest.raises(ValueError):
+        liststring_histogram("512\n5x2\n")
+    with pytest.raises(ValueError):
+        liststring_avg_stdev("512 ERR")
+
+def test_liststring_avg_stdev():
+    assert liststring_avg_stdev("1 3\n5") == pytest.approx((3, np.std([1, 3, 5])))
+    assert liststring_avg_stdev(np.array([2, 2])) == (2, 0)
+
+def test_bitstring_avg(dbg_log):
+    assert bitstring_avg("0110") == 0.5
+    assert bitstring_avg(np.array([1, 1, 1, 0], dtype=np.uint8)) == 0.75
+
+
+@pytest.fixture
+def fake_comparator(dbg_log, monkeypatch):
+    """Replaces the AWG and the HAL with a comparator whose trip point depends on the CDAC code."""
+    trip_mV = {"0111111111": 499.5, "1000000000": 500.0, "1000000001": 500.6}
+    Vin = {"mV": 0}
+
+    def set_Vin_mV(v):
+        Vin["mV"] = v
+
+    def cdac100x(log, port, cmd_txt):
+        code = cmd_txt.split(":")[1]
+        return np.full(100, 1 if Vin["mV"] > trip_mV[code] else 0, dtype=np.uint8)
+
+    monkeypatch.setattr(Spacely_Utils, "config_AWG_as_DC", set_Vin_mV, raising=False)
+    monkeypatch.setattr(Spacely_Utils, "set_Vin_mV", set_Vin_mV, raising=False)
+    monkeypatch.setattr(Spacely_Utils, "command_ng_bits", cdac100x)
+    monkeypatch.setattr(sg, "port", None, raising=False)
+
+def test_DNL(fake_comparator):
+    assert find_DNL() == pytest.approx(0.1)
+
+def test_DNL_samples(fake_comparator):
+    DNL, samples = find_DNL(return_samples=True)
+    assert DNL == pytest.approx(0.1)
+    assert sorted(samples) == ["0111111111", "1000000000", "1000000001"]
+    assert samples["1000000000"][500.0] == 0
+
+def test_DNL_empty_sweep(fake_comparator):
+    assert find_DNL(500, 500) is None
+
+
+def test_histogram_stats():
+    mode, mean, count_below, count_above = histogram_stats({511: 10, 512: 80, 513: 30})
+    assert mode == 512
+    assert mean == pytest.approx((511*10 + 512*80 + 513*30) / 120)
+    assert (count_below, count_above) == (10, 30)
+
+def test_histogram_stats_single_bin():
+    assert histogram_stats({7: 1000}) == (7, 7, 0, 0)
+
+
+@pytest.fixture
+def fake_hal(dbg_log, monkeypatch):
+    """Replaces the AWG and the HAL's conversion commands. hal["hist"] is what histNx
+       returns, or an exception for it to raise; convNx returns hal["conv"]."""
+    hal = {"hist": {}, "conv": np.array([], dtype=np.int64), "commands": []}
+
+    def command_hist(log, port, points):
+        hal["commands"].append(f"histNx:{points}")
+        if isinstance(hal["hist"], Exception):
+            raise hal["hist"]
+        return hal["hist"]
+
+    def command_ng_array(log, port, cmd_txt):
+        hal["commands"].append(cmd_txt)
+        return hal["conv"]
+
+    monkeypatch.setattr(Spacely_Utils, "config_AWG_as_DC", lambda v: None, raising=False)
+    monkeypatch.setattr(Spacely_Utils, "command_hist", command_hist)
+    monkeypatch.setattr(Spacely_Utils, "command_ng_array", command_ng_array)
+    monkeypatch.setattr(sg, "TARGET", "SPROCKET1", raising=False)
+    monkeypatch.setattr(sg, "port", None, raising=False)
+    return hal
+
+def test_Vin_histogram(fake_hal):
+    fake_hal["hist"] = {511: 1, 512: 2}
+    assert Vin_histogram(500, 3) == {511: 1, 512: 2}
+    assert fake_hal["commands"] == ["histNx:3"]
+
+@pytest.mark.parametrize("hist", [IOError("HAL histNx failed: ERR: histNx is not available on the UNO"), {}])
+def test_Vin_histogram_fallback(fake_hal, hist):
+    # Rejected (UNO build, binary mode) or unknown (older firmware): use convNx instead.
+    fake_hal["hist"] = hist
+    fake_hal["conv"] = np.array([512, 511, 512])
+    assert Vin_histogram(500, 3) == {511: 1, 512: 2}
+    assert fake_hal["commands"] == ["histNx:3", "convNx:3"]
+
+
+@pytest.fixture
+def fake_adc(dbg_log, monkeypatch):
+    """Replaces Vin_histogram() with an ADC with 1 mV codes (code k spans k to k+1 mV, or
+       k*lsb_mV to (k+1)*lsb_mV) and Gaussian input noise, so a code is centered at k+0.5 mV.
+       Histograms are the expected counts rather than random draws, so the search is repeatable."""
+    adc = {"noise_mV": 0.3, "lsb_mV": 1.0, "histograms": 0}
+
+    def Vin_histogram(Vtest_mV, points):
+        adc["histograms"] += 1
+        noise = NormalDist(Vtest_mV, adc["noise_mV"])
+        lsb = adc["lsb_mV"]
+        histogram = {}
+        for code in range(int(Vtest_mV // lsb) - 5, int(Vtest_mV // lsb) + 6):
+            count = round(points * (noise.cdf((code + 1) * lsb) - noise.cdf(code * lsb)))
+            if count > 0:
+                histogram[code] = count
+        return histogram
+
+    monkeypatch.setattr(Spacely_Utils, "Vin_histogram", Vin_histogram)
+    return adc
+
+@pytest.mark.parametrize("Vtest_init_mV", [500.1, 500.5, 500.85])
+def test_center_code(fake_adc, Vtest_init_mV):
+    assert center_code(Vtest_init_mV) == pytest.approx(500.5, abs=0.1)
+
+def linear_center_code(Vtest_init_mV, samples_per_val=1000):
+    """The original centering search: 0.1 mV steps until the histogram stops improving.
+       Returns the number of histograms it takes, and how many samples are still outside the mode."""
+    histograms = 1
+    Vtest_last = Vtest_init_mV
+    mode, mean, count_below, count_above = histogram_stats(Spacely_Utils.Vin_histogram(Vtest_last, samples_per_val))
+    count_outside = count_below + count_above
+    while count_outside > 0:
+        Vtest = Vtest_last - 0.1 if count_above > count_below else Vtest_last + 0.1
+        histograms += 1
+        mode, mean, count_below, count_above = histogram_stats(Spacely_Utils.Vin_histogram(Vtest, samples_per_val))
+        if count_below + count_above >= count_outside:
+            break
+        Vtest_last = Vtest
+        count_outside = count_below + count_above
+    return histograms, count_outside
+
+def test_center_code_secant(fake_adc):
+    # Starting 0.4 mV off, 0.1 mV steps alone take 6 histograms: 4 steps, and one more
+    # to see that the next step makes things worse.
+    # Seeding the first step from the offset gets there in 3.
+    center_code(500.1)
+    assert fake_adc["histograms"] <= 3
+
+@pytest.mark.parametrize("lsb_mV, Vtest_init_mV", [(1, 500.1), (1, 500.85), (1, 499.95),
+                                                   (10, 509.9), (10, 500.2), (10, 500.05)])
+def test_center_code_fewer_histograms(fake_adc, lsb_mV, Vtest_init_mV):
+    fake_adc["lsb_mV"] = lsb_mV
+    linear_histograms, linear_count_outside = linear_center_code(Vtest_init_mV)
+    fake_adc["histograms"] = 0
+
+    Vtest = center_code(Vtest_init_mV, lsb_mV=lsb_mV)
+    assert fake_adc["histograms"] < linear_histograms
+
+    # As centered as the linear search gets, give or take a few samples: both stop within
+    # 0.1 mV of the center.
+    mode, mean, count_below, count_above = histogram_stats(Spacely_Utils.Vin_histogram(Vtest, 1000))
+    assert count_below + count_above <= linear_count_outside + 5
+
+def test_center_code_quiet(fake_adc):
+    # Without noise every sample already lands in one code; no search is needed.
+    fake_adc["noise_mV"] = 0.01
+    assert center_code(500.3) == 500.3
+    assert fake_adc["histograms"] == 1
@@ -0,0 +1,195 @@
+import pytest
+import sys
+import os
+
+import numpy as np
+
+sys.path.append(os.path.abspath("."))
+sys.path.append(os.path.abspath("./src"))
+from hal_serial import *
+
+import fnal_log_wizard as liblog
+
+
+class FakePort:
+    """Stands in for a serial.Serial: read() hands out the scripted HAL output a few
+       bytes at a time, and returns b'' (a quiet read) once it has all been sent."""
+
+    def __init__(self, rx=b"", chunk=5):
+        self.rx = bytearray(rx)
+        self.chunk = chunk
+        self.tx = []
+        self.timeout = 1
+        self.is_open = True
+        self.out_waiting = 0
+
+    @property
+    def in_waiting(self):
+        return min(len(self.rx), self.chunk)
+
+    def write(self, data):
+        self.tx.append(bytes(data))
+
+    def read(self, n=1):
+        data = bytes(self.rx[:n])
+        del self.rx[:n]
+        return data
+
+    def readline(self):
+        end = self.rx.find(b"\n")
+        return self.read(len(self.rx) if end < 0 else end + 1)
+
+
+@pytest.fixture
+def dbg_log():
+    return liblog.PlainLogger(liblog.HandleOutputStrategy())
+
+
+def test_stream_lines(dbg_log):
+    port = FakePort(b"a\r\nb\r\n?#note\r\nc\r\n?")
+    assert list(command_stream(dbg_log, port, "x")) == ["a", "b", "c"]
+    assert port.tx == [b"x"]
+
+def test_stream_prompt_after_text(dbg_log):
+    # The last line does not need a newline before the prompt.
+    port = FakePort(b"foo?")
+    assert list(command_stream(dbg_log, port, "x", idle_timeout_s=1)) == ["foo"]
+    port = FakePort(b"1\r\n2?")
+    assert list(command_stream(dbg_log, port, "x", parse=int, idle_timeout_s=1)) == [1, 2]
+
+def test_stream_restores_timeout(dbg_log):
+    port = FakePort(b"?")
+    port.timeout = 3
+    assert list(command_stream(dbg_log, port, "x")) == []
+    assert port.timeout == 3
+
+def test_command_restores_timeout():
+    port = FakePort(b"IDN\r\nArduino HAL\r\n?")
+    port.timeout = 3
+    assert command(port, "IDN", printresponse=False) == "IDN\r\nArduino HAL\r\n?"
+    assert port.tx == [b"IDN\n"]
+    assert port.timeout == 3
+
+@pytest.mark.skipif(os.name != "posix", reason="AsyncHal needs a POSIX serial port")
+def test_async_hal_restores_blocking(dbg_log):
+    import asyncio
+    import pty
+
+    master, slave = pty.openpty()
+
+    class PtyPort:
+        def fileno(self):
+            return slave
+
+    async def start_and_close():
+        async with AsyncHal(dbg_log, PtyPort()):
+            assert not os.get_blocking(slave)
+
+    try:
+        asyncio.run(start_and_close())
+        assert os.get_blocking(slave)
+    finally:
+        os.close(master)
+        os.close(slave)
+
+def test_stream_binary_prompt(dbg_log):
+    # After "bin:on" the prompt is a frame, which must also end the stream.
+    port = FakePort(b"ERR: no\r\n" + HAL_PROMPT_FRAME)
+    assert list(command_stream(dbg_log, port, "x", idle_timeout_s=1)) == ["ERR: no"]
+
+def test_hist(dbg_log):
+    port = FakePort(b"histNx:100\r\n511,10\r\n512,80\r\n513,10\r\n?")
+    assert command_hist(dbg_log, port, 100, idle_timeout_s=1) == {511: 10, 512: 80, 513: 10}
+    assert port.tx == [b"histNx:100"]
+
+def test_hist_rejected(dbg_log):
+    port = FakePort(b"histNx:100\r\nERR: histNx is not available in binary mode, send bin:off first\r\n"
+                    + HAL_PROMPT_FRAME)
+    with pytest.raises(IOError):
+        command_hist(dbg_log, port, 100, idle_timeout_s=1)
+    # The whole response was read, up to the prompt frame.
+    assert port.rx == b""
+
+
+def frame(frame_type, payload=b""):
+    body = bytes([frame_type]) + len(payload).to_bytes(2, "little") + payload
+    return bytes([HAL_FRAME_SYNC]) + body + fletcher16(body).to_bytes(2, "little")
+
+def test_fletcher16():
+    # Reference values for the Fletcher-16 checksum.
+    assert fletcher16(b"abcde") == 0xC8F0
+    assert fletcher16(b"abcdef") == 0x2057
+    assert fletcher16(b"abcdefgh") == 0x0627
+    assert fletcher16(b"") == 0
+    # Long inputs, where the sums wrap many times.
+    data = bytes(range(256)) * 40
+    sum1 = sum2 = 0
+    for byte in data:
+        sum1 = (sum1 + byte) % 255
+        sum2 = (sum2 + sum1) % 255
+    assert fletcher16(data) == (sum2 << 8) | sum1
+
+def test_prompt_frame():
+    assert HAL_PROMPT_FRAME == frame(HAL_FRAME_PROMPT)
+
+def test_frame_parser(dbg_log):
+    parser = HalFrameParser(dbg_log)
+    data = frame(HAL_FRAME_U16, b"\x01\x00\x02\x00")
+    assert parser.feed(b"text\r\n" + data + frame(HAL_FRAME_PROMPT)) == [
+        (None, b"text\r\n"), (HAL_FRAME_U16, b"\x01\x00\x02\x00"), (HAL_FRAME_PROMPT, b"")]
+
+def test_frame_parser_split(dbg_log):
+    # Frames split anywhere across reads come out whole, once complete.
+    stream = b"hi" + frame(HAL_FRAME_U16, bytes(range(10))) + frame(HAL_FRAME_PROMPT)
+    parser = HalFrameParser(dbg_log)
+    items = []
+    for i in range(len(stream)):
+        items += parser.feed(stream[i:i+1])
+    assert [item for item in items if item[0] is not None] == [
+        (HAL_FRAME_U16, bytes(range(10))), (HAL_FRAME_PROMPT, b"")]
+    assert b"".join(payload for frame_type, payload in items if frame_type is None) == b"hi"
+
+def test_frame_parser_bad_checksum(dbg_log):
+    bad = bytearray(frame(HAL_FRAME_U16, b"\x01\x00"))
+    bad[-1] ^= 0xFF
+    parser = HalFrameParser(dbg_log)
+    items = parser.feed(bytes(bad) + frame(HAL_FRAME_PROMPT))
+    # The damaged frame is dropped; the next one is still found.
+    assert (HAL_FRAME_U16, b"\x01\x00") not in items
+    assert items[-1] == (HAL_FRAME_PROMPT, b"")
+
+def test_command_bin(dbg_log):
+    values = np.array([0, 1, 511, 1023], dtype="<u2")
+    port = FakePort(b"conv100x\r\n" + frame(HAL_FRAME_U16, values[:2].tobytes())
+                    + frame(HAL_FRAME_U16, values[2:].tobytes()) + frame(HAL_FRAME_PROMPT))
+    port.timeout = 3
+    text, data = command_bin(dbg_log, port, "conv100x")
+    assert text == "conv100x"
+    assert data.tolist() == [0, 1, 511, 1023]
+    assert port.timeout == 3
+
+
+def test_ng_array(dbg_log):
+    port = FakePort(b"conv100x\r\n" + b"".join(b"%d\n" % v for v in range(500, 600)) + b"?")
+    values = command_ng_array(dbg_log, port, "conv100x")
+    assert values.tolist() == list(range(500, 600))
+    assert port.tx == [b"conv100x"]
+
+def test_ng_array_no_echo(dbg_log):
+    port = FakePort(b"1023\r\n0\r\n7\r\n?")
+    assert command_ng_array(dbg_log, port, "conv100x").tolist() == [1023, 0, 7]
+
+def test_ng_array_bad_reply(dbg_log):
+    # Anything that isn't an integer is an error, not silently dropped or truncated.
+    port = FakePort(b"conv100x\r\n512\r\nERR: busy\r\n?")
+    with pytest.raises(ValueError):
+        command_ng_array(dbg_log, port, "conv100x")
+    port = FakePort(b"512\r\n51x\r\n?")
+    with pytest.raises(ValueError):
+        command_ng_array(dbg_log, port, "conv100x")
+
+def test_ng_bits(dbg_log):
+    port = FakePort(b"cdac100x:1000000000\r\n0110100001\r\n?")
+    bits = command_ng_bits(dbg_log, port, "cdac100x:1000000000")
+    assert bits.dtype == np.uint8
+    assert bits.tolist() == [0, 1, 1, 0, 1, 0, 0, 0, 0, 1]
@@ -0,0 +1,298 @@
+import pytest
+import sys
+import os
+
+import numpy as np
+
+sys.path.append(os.path.abspath("."))
+sys.path.append(os.path.abspath("./src"))
+from Spacely_Caribou import *
+from VirtualCaribou import *
+from pattern_runner import *
+
+import fnal_log_wizard as liblog
+
+APG_REGS = ["clear", "run", "status", "n_samples", "write_channel", "read_channel",
+            "write_buffer_len", "param_NUM_SAMP"]
+
+
+class FakeApgs:
+    """Emulates APGs on a VirtualCaribou. write_channel appends to the write buffer,
+       run plays the first n_samples of it, and read_channel returns what was played,
+       each sample + 1 (standing in for the ASIC's response). clear empties both.
+       With latency > 0 the response lags by that many samples, and the first samples
+       of every run read back 0, as from an idle APG."""
+
+    def __init__(self, vc, monkeypatch, apg_names, num_samp=64, latency=0):
+        self.vc = vc
+        self.latency = latency
+        self.write_buffer = {apg_name: [] for apg_name in apg_names}
+        self.read_buffer = {apg_name: [] for apg_name in apg_names}
+        self.uploads = {apg_name: 0 for apg_name in apg_names}
+        for apg_name in apg_names:
+            vc.reg[f"{apg_name}_param_NUM_SAMP"] = num_samp
+
+        self._set_memory = vc.device_set_memory
+        self._get_memory = vc.device_get_memory
+        monkeypatch.setattr(vc, "device_set_memory", self.set_memory)
+        monkeypatch.setattr(vc, "device_get_memory", self.get_memory)
+
+    def set_memory(self, args):
+        apg_name, reg = args[0].split("_", 1)
+        if reg == "write_channel":
+            self.write_buffer[apg_name].append(int(args[1]))
+            return
+        self._set_memory(args)
+        if reg == "clear":
+            self.write_buffer[apg_name] = []
+            self.read_buffer[apg_name] = []
+        elif reg == "run":
+            n_samples = self.vc.reg[f"{apg_name}_n_samples"]
+            response = [0] * self.latency + [v + 1 for v in self.write_buffer[apg_name]]
+            self.read_buffer[apg_name] += response[:n_samples]
+
+    def get_memory(self, args):
+        apg_name, reg = args[0].split("_", 1)
+        if reg == "read_channel":
+            return self.read_buffer[apg_name].pop(0)
+        if reg == "write_buffer_len":
+            return len(self.write_buffer[apg_name])
+        if reg == "status":
+            return 0
+        return self._get_memory(args)
+
+
+@pytest.fixture
+def dbg_log():
+    return liblog.PlainLogger(liblog.HandleOutputStrategy())
+
+@pytest.fixture
+def car(dbg_log):
+    car = Caribou("EMULATE",12345,"SpacelyCaribouBasic", dbg_log)
+    car.set_axi_registers([f"{apg_name}_{reg}" for apg_name in ["apg0", "apg1"] for reg in APG_REGS])
+    yield car
+    car.close()
+
+@pytest.fixture
+def apgs(car, monkeypatch):
+    apgs = FakeApgs(car._client.vc, monkeypatch, ["apg0", "apg1"])
+    # Count uploads as block writes to write_channel.
+    set_memory_block = car._client.vc.device_set_memory_block
+    def counting_set_memory_block(args):
+        apgs.uploads[args[0].split("_", 1)[0]] += 1
+        return set_memory_block(args)
+    monkeypatch.setattr(car._client.vc, "device_set_memory_block", counting_set_memory_block)
+    return apgs
+
+@pytest.fixture
+def pr(dbg_log, car):
+    return CaribouPatternRunner(dbg_log, None, car)
+
+def wave(values, apg_name="apg0"):
+    return GlueWave(list(values), 1e12/APG_CLOCK_FREQUENCY, f"Caribou/{apg_name}/write")
+
+
+def test_run_pattern(pr, apgs):
+    result = pr.run_pattern(wave([1, 2, 3]), tsf=2)
+    assert list(result.vector) == [2, 2, 3, 3, 4, 4]
+
+def test_cache_hit_skips_upload(pr, apgs):
+    for _ in range(3):
+        assert list(pr.run_pattern(wave([1, 2, 3])).vector) == [2, 3, 4]
+    assert apgs.uploads["apg0"] == 1
+
+    # A different pattern, or the same one at another tsf, is uploaded.
+    assert list(pr.run_pattern(wave([5, 6])).vector) == [6, 7]
+    assert list(pr.run_pattern(wave([5, 6]), tsf=2).vector) == [6, 6, 7, 7]
+    assert apgs.uploads["apg0"] == 3
+
+def test_cache_checks_write_buffer(pr, apgs):
+    pr.run_pattern(wave([1, 2, 3]))
+    # Something else emptied the write buffer behind the runner's back.
+    apgs.write_buffer["apg0"] = []
+    assert list(pr.run_pattern(wave([1, 2, 3])).vector) == [2, 3, 4]
+    assert apgs.uploads["apg0"] == 2
+
+def test_invalidate_pattern_cache(pr, apgs):
+    pr.run_pattern(wave([1, 2, 3]))
+    pr.invalidate_pattern_cache("apg0")
+    pr.run_pattern(wave([1, 2, 3]))
+    assert apgs.uploads["apg0"] == 2
+
+    pr.invalidate_pattern_cache()
+    pr.run_pattern(wave([1, 2, 3]))
+    assert apgs.uploads["apg0"] == 3
+
+def test_return_mode_0(pr, apgs):
+    # Replays without reading back keep the pattern loaded.
+    for _ in range(3):
+        assert pr.run_pattern(wave([1, 2, 3]), return_mode=0) is None
+    assert apgs.uploads["apg0"] == 1
+    assert len(apgs.read_buffer["apg0"]) == 9
+
+    # The next readback must not see the samples left over from those runs.
+    assert list(pr.run_pattern(wave([1, 2, 3])).vector) == [2, 3, 4]
+    assert apgs.uploads["apg0"] == 2
+    assert apgs.read_buffer["apg0"] == []
+
+def test_run_patterns_matches_run_pattern(dbg_log, car, pr, apgs):
+    waves = [wave([1, 2, 3], "apg0"), wave([10, 20], "apg1")]
+    results = pr.run_patterns(waves, tsf=2)
+
+    sequential = CaribouPatternRunner(dbg_log, None, car)
+    for result, glue_wave in zip(results, waves):
+        assert list(result.vector) == list(sequential.run_pattern(glue_wave, tsf=2).vector)
+    assert list(results[1].vector) == [11, 11, 21, 21]
+
+def test_run_patterns_cache(pr, apgs):
+    waves = [wave([1, 2, 3], "apg0"), wave([10, 20], "apg1")]
+    pr.run_patterns(waves)
+    pr.run_patterns(waves)
+    assert apgs.uploads == {"apg0": 1, "apg1": 1}
+
+    # Patterns loaded by run_pattern() are reused by run_patterns() and vice versa.
+    pr.run_pattern(wave([4, 5], "apg0"))
+    results = pr.run_patterns([wave([4, 5], "apg0"), wave([10, 20], "apg1")])
+    assert [list(result.vector) for result in results] == [[5, 6], [11, 21]]
+    assert apgs.uploads == {"apg0": 2, "apg1": 1}
+
+def test_run_patterns_errors(pr, apgs):
+    # Two waves for one APG, or a wave too long for the APG's memory.
+    assert pr.run_patterns([wave([1], "apg0"), wave([2], "apg0")]) == -1
+    assert pr.run_patterns([wave(range(100), "apg0")]) == -1
+
+
+@pytest.fixture
+def slow_apgs(car, monkeypatch):
+    # An APG with room for 16 samples, driving a DUT which responds 2 cycles later.
+    return FakeApgs(car._client.vc, monkeypatch, ["apg0", "apg1"], num_samp=16, latency=2)
+
+def test_stream_pattern(pr, slow_apgs):
+    values = list(range(1, 41))
+    # What a single run would read back if the APG were big enough.
+    expected = [0, 0] + [v + 1 for v in values[:-2]]
+
+    # Without overlap, each chunk starts with the response to the idle APG.
+    streamed = list(pr.run_pattern(wave(values)).vector)
+    assert len(streamed) == len(values)
+    for i in range(len(values)):
+        if i % 16 >= 2:
+            assert streamed[i] == expected[i]
+    assert streamed[16:18] == [0, 0]
+
+    # Overlapping the chunks by the latency trims those samples.
+    pr.stream_overlap = 2
+    assert list(pr.run_pattern(wave(values)).vector) == expected
+    assert list(pr.stream_pattern(wave(values), tsf=2, overlap=2).vector) == \
+        [0, 0] + [v + 1 for v in np.repeat(values, 2)[:-2]]
+
+def test_stream_pattern_bad_overlap(pr, slow_apgs):
+    assert pr.stream_pattern(wave(range(40)), overlap=16) == -1
+
+
+def baseline_diagnosis(rp):
+    """The diagnosis the original loop-based diagnose_fifo_timeout() printed, as a list of
+       events: ("timeout", value, duration, counts_since_last) or ("skip", from, to)."""
+    events = []
+    pattern_started = False
+    in_timeout = False
+    timeout_count = 0
+    last_timeout = 0
+    this_timeout = 0
+
+    for i in range(len(rp)):
+        if i > 2 and rp[i] == 3 and rp[i-1] == 2 and rp[i-2] == 1 and rp[i-3] == 0:
+            pattern_started = True
+
+        if pattern_started:
+            if in_timeout:
+                if rp[i] == this_timeout + 1:
+                    events.append(("timeout", this_timeout, timeout_count, this_timeout - last_timeout))
+                    in_timeout = False
+                    timeout_count = 0
+                    last_timeout = this_timeout
+                elif rp[i] == rp[i-1] + 1:
+                    events.append(("skip", this_timeout, rp[i-1]))
+                    in_timeout = False
+                    timeout_count = 0
+                    last_timeout = this_timeout
+                else:
+                    timeout_count = timeout_count + 1
+            elif rp[i] != rp[i-1] + 1:
+                in_timeout = True
+                timeout_count = 1
+                this_timeout = rp[i-1]
+
+    return pattern_started, events
+
+def report_events(report):
+    events = []
+    for i in range(len(report["position"])):
+        if report["skip"][i]:
+            events.append(("skip", report["value"][i], report["skip_to"][i]))
+        else:
+            events.append(("timeout", report["value"][i], report["duration"][i], report["counts_since_last"][i]))
+    return report["start"] is not None, events
+
+
+def test_diagnose_no_start():
+    report = diagnose_fifo_timeout([5, 6, 0, 1, 2, 9, 10])
+    assert report["start"] is None
+    assert report["unterminated"] is None
+    assert len(report["position"]) == 0
+
+def test_diagnose_no_timeouts():
+    report = diagnose_fifo_timeout([7, 7, 0, 1, 2, 3, 4, 5, 6])
+    # Anything before the start of the count is ignored.
+    assert report["start"] == 5
+    assert report["unterminated"] is None
+    assert len(report["position"]) == 0
+
+def test_diagnose_resume():
+    # The count stalls at 5 for 3 samples, then resumes at 6.
+    rp = [0, 1, 2, 3, 4, 5, 5, 5, 5, 6, 7]
+    report = diagnose_fifo_timeout(rp)
+    assert report["start"] == 3
+    assert report["position"].tolist() == [6]
+    assert report["value"].tolist() == [5]
+    assert report["duration"].tolist() == [3]
+    assert report["counts_since_last"].tolist() == [5]
+    assert report["skip"].tolist() == [False]
+    assert report["skip_to"].tolist() == [-1]
+    assert report_events(report) == baseline_diagnosis(rp)
+
+def test_diagnose_skip():
+    # The count stalls at 5, then carries on from 20: samples 6 to 19 were lost.
+    rp = [0, 1, 2, 3, 4, 5, 5, 20, 21, 22, 23, 23, 24]
+    report = diagnose_fifo_timeout(rp)
+    assert report["skip"].tolist() == [True, False]
+    assert report["skip_to"].tolist() == [20, -1]
+    assert report["value"].tolist() == [5, 23]
+    assert report["counts_since_last"].tolist() == [5, 18]
+    assert report_events(report) == baseline_diagnosis(rp)
+
+def test_diagnose_unterminated():
+    # The count stalls at 5 and never recovers.
+    rp = [0, 1, 2, 3, 4, 5, 0, 0, 0]
+    report = diagnose_fifo_timeout(rp)
+    assert report["unterminated"] == 6
+    assert len(report["position"]) == 0
+    assert report_events(report) == baseline_diagnosis(rp)
+
+def test_diagnose_matches_baseline():
+    rng = np.random.default_rng(1234)
+    for _ in range(200):
+        # A count with random stalls, skips and glitches, and some noise before it starts.
+        rp = list(rng.integers(0, 4, rng.integers(0, 6)))
+        v = 0
+        while len(rp) < 200:
+            r = rng.random()
+            if r < 0.05:
+                rp += [v - 1] * int(rng.integers(1, 5))
+            elif r < 0.08:
+                v += int(rng.integers(2, 10))
+            elif r < 0.10:
+                rp.append(int(rng.integers(0, 300)))
+            rp.append(v)
+            v += 1
+        assert report_events(diagnose_fifo_timeout(rp)) == baseline_diagnosis(rp)
@@ -108,3 +108,72 @@ def ROUTINE_test_cadder_mode1_2():
         if i%8 == 0:
             print("") #Newline after every 8 
         
+
+
+class UnprefixedApgCaribou:
+    """Presents the test firmware's APG registers ("clear", "run", ...) under an APG
+       name, the way CaribouPatternRunner addresses them ("apg_clear", "apg_run", ...)."""
+
+    def __init__(self, car, apg_name):
+        self.car = car
+        self.prefix = apg_name + "_"
+
+    def _reg(self, mem_name):
+        return mem_name[len(self.prefix):] if mem_name.startswith(self.prefix) else mem_name
+
+    def set_memory(self, mem_name, value):
+        return self.car.set_memory(self._reg(mem_name), value)
+
+    def get_memory(self, mem_name):
+        return self.car.get_memory(self._reg(mem_name))
+
+    def set_memory_block(self, mem_name, values):
+        return self.car.set_memory_block(self._reg(mem_name), values)
+
+    def get_memory_block(self, mem_name, n):
+        return self.car.get_memory_block(self._reg(mem_name), n)
+
+    def batch(self):
+        return self.car.batch()
+
+
+def ROUTINE_test_apg_tsf_stream():
+    """Run the same time-scaled pattern from APG memory and streamed in chunks (twin mode 1 or 2)"""
+
+    LOOPBACK_OFFSET_CYC = 2
+    TSF = 2
+    CHUNK_LEN = 16
+
+    sg.INSTR["car"].set_memory("divider_cycles",5)
+    sg.INSTR["car"].set_memory("divider_rstn",0)
+    sg.INSTR["car"].set_memory("divider_rstn",1)
+
+    car = UnprefixedApgCaribou(sg.INSTR["car"], "apg")
+    pr = CaribouPatternRunner(sg.log, None, car)
+
+    input_vector = [random.randint(0,255) for _ in range(40)]
+    glue_wave = GlueWave(input_vector, 1e12/APG_CLOCK_FREQUENCY, "Caribou/apg/write")
+
+    in_memory = pr.run_pattern(glue_wave, tsf=TSF)
+
+    #Pretend the APG is small, so that the same pattern has to be streamed.
+    pr._apg_num_samp["apg"] = CHUNK_LEN
+    streamed = pr.run_pattern(glue_wave, tsf=TSF)
+
+    in_memory = list(in_memory.vector)
+    streamed = list(streamed.vector)
+
+    #Both play and return the time-scaled pattern.
+    assert len(in_memory) == len(input_vector) * TSF
+    assert len(streamed) == len(input_vector) * TSF
+
+    #Each streamed chunk is a separate run, so the first samples of every chunk
+    #are still the loopback of the idle APG.
+    for i in range(len(in_memory)):
+        if i % CHUNK_LEN >= LOOPBACK_OFFSET_CYC:
+            assert streamed[i] == in_memory[i], f"Sample {i}: streamed {streamed[i]} != in-memory {in_memory[i]}"
+
+    #Overlapping the chunks by the loopback offset trims those samples.
+    pr.stream_overlap = LOOPBACK_OFFSET_CYC
+    streamed = list(pr.run_pattern(glue_wave, tsf=TSF).vector)
+    assert streamed == in_memory